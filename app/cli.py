@@ -0,0 +1,66 @@
+import argparse
+import sys
+
+import app.db_functions as db
+import app.migrations as migrations
+
+def migrate(args):
+    applied = migrations.apply_migrations()
+    print(f'Applied migration(s) {", ".join(map(str, applied))}' if applied else 'Nothing to migrate',
+          f'(schema version {migrations.LATEST_VERSION})')
+
+def reconcile_scores(args):
+    drift = db.reconcile_scores(dry_run=args.dry_run)
+    for user_id, stored_score, actual_score, stored_count, actual_count in drift:
+        print(f'user {user_id}: score stored {stored_score}, actual {actual_score}; '
+              f'achievements stored {stored_count}, actual {actual_count}')
+    print(f'{len(drift)} user(s) drifted' + (' (dry run, nothing changed)' if args.dry_run else ', fixed'))
+
+def rebuild_streaks(args):
+    print(f'{db.rebuild_streaks()} streak(s) rebuilt')
+
+def rebuild_activity(args):
+    print(f'{db.rebuild_activity()} day(s) of activity rebuilt')
+
+def export_data(args):
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    with output:
+        for chunk in db.export_ndjson():
+            output.write(chunk)
+
+def import_data(args):
+    db.create_db()
+    with (sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')) as lines:
+        counts = db.import_records(db.read_records(lines))
+    print(f"{counts['users']} user(s), {counts['achievements']} achievement(s), {counts['grants']} grant(s) imported")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m app.cli', description='Offline maintenance commands')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    upgrade = commands.add_parser('migrate', help='Create the schema or apply its pending migrations')
+    upgrade.set_defaults(func=migrate)
+
+    reconcile = commands.add_parser('reconcile-scores', help='Recompute every user total_score and achievement_count and report drift')
+    reconcile.add_argument('--dry-run', action='store_true', help='Only report drift, do not fix it')
+    reconcile.set_defaults(func=reconcile_scores)
+
+    streaks = commands.add_parser('rebuild-streaks', help='Recompute every user current streak from the grant history')
+    streaks.set_defaults(func=rebuild_streaks)
+
+    activity = commands.add_parser('rebuild-activity', help='Recompute the daily activity of every user from the grant history')
+    activity.set_defaults(func=rebuild_activity)
+
+    export = commands.add_parser('export', help='Write every user, achievement and grant as NDJSON')
+    export.add_argument('output', nargs='?', default='-', help='Output file (default: stdout)')
+    export.set_defaults(func=export_data)
+
+    load = commands.add_parser('import', help='Load NDJSON written by export, keeping ids, and recompute scores, streaks and activity')
+    load.add_argument('input', nargs='?', default='-', help='Input file (default: stdin)')
+    load.set_defaults(func=import_data)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,224 @@
-from peewee import PostgresqlDatabase, CharField, FixedCharField, IntegerField, ForeignKeyField, Check, AutoField, DateTimeField, fn
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from contextvars import ContextVar
+
+from peewee import PostgresqlDatabase, DatabaseError, InterfaceError, CharField, FixedCharField, CompositeKey, IntegerField, ForeignKeyField, Check, AutoField, DateTimeField, DateField, Case, EXCLUDED, JOIN, SQL, fn, _ConnectionState
+from playhouse.pool import PooledPostgresqlDatabase, MaxConnectionsExceeded, _sentinel
 from playhouse.signals import Model as SignalModel, post_save
 from os import getenv
 
-database = PostgresqlDatabase(getenv('DB_URL'))
+logger = logging.getLogger(__name__)
+
+# Statements slower than this are logged with their SQL
+SLOW_QUERY_MS = float(getenv('DB_SLOW_QUERY_MS', 200))
+
+class QueryStats:
+    """Number of statements and time spent in the database, for one request"""
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+query_stats: ContextVar[QueryStats] = ContextVar('query_stats', default=None)
+
+def track_queries() -> QueryStats:
+    """Start counting the statements of the current context (e.g. an HTTP request), including the threadpool calls it makes"""
+    stats = QueryStats()
+    query_stats.set(stats)
+    return stats
+
+def record_query(sql: str, params, seconds: float) -> None:
+    """Account a statement run by either backend to the current request, and log it when slow"""
+    stats = query_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += seconds
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        logger.warning('Slow query (%.1f ms): %s %r', seconds * 1000, sql, params)
+
+class ContextConnectionState(_ConnectionState):
+    """Connection state kept in a ContextVar, so a request shares one connection across threadpool calls"""
+    def __init__(self, **kwargs):
+        super().__setattr__('_state', ContextVar('db_state'))
+        super().__init__(**kwargs)
+
+    def _current(self) -> dict:
+        try:
+            return self._state.get()
+        except LookupError:
+            self.new_context()
+            return self._state.get()
+
+    def __setattr__(self, name, value):
+        self._current()[name] = value
+
+    def __getattr__(self, name):
+        try:
+            return self._current()[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def new_context(self):
+        """Start a fresh connection state for the current context (e.g. an HTTP request)"""
+        self._state.set({})
+        self.reset()
+
+class CountingPostgresqlDatabase(PostgresqlDatabase):
+    connections_created = 0
+
+    def _connect(self):
+        conn = super()._connect()
+        self.connections_created += 1
+        return conn
+
+class PooledDatabase(PooledPostgresqlDatabase, CountingPostgresqlDatabase):
+    """Connection pool with a warm minimum size and usage statistics"""
+    def __init__(self, database, min_connections=0, **kwargs):
+        self._min_connections = int(min_connections)
+        self._waiting = 0
+        self._stats_lock = threading.Lock()
+        super().__init__(database, **kwargs)
+        self._state = ContextConnectionState()
+
+    def connect(self, reuse_if_open=False):
+        if not self._wait_timeout:
+            return super().connect(reuse_if_open)
+        waiting = False
+        expires = time.time() + self._wait_timeout
+        try:
+            while True:
+                try:
+                    return PostgresqlDatabase.connect(self, reuse_if_open)
+                except MaxConnectionsExceeded:
+                    if time.time() >= expires:
+                        raise MaxConnectionsExceeded('Max connections exceeded, timed out attempting to connect.')
+                    if not waiting:
+                        waiting = True
+                        with self._stats_lock:
+                            self._waiting += 1
+                    time.sleep(0.01)
+        finally:
+            if waiting:
+                with self._stats_lock:
+                    self._waiting -= 1
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, *args, **kwargs)
+        finally:
+            record_query(sql, params, time.perf_counter() - start)
+
+    def fill(self) -> None:
+        """Open idle connections until the pool holds at least `min_connections`"""
+        target = min(self._min_connections, self._max_connections or self._min_connections)
+        with self._pool_lock:
+            while len(self._connections) + len(self._in_use) < target:
+                heapq.heappush(self._connections, (time.time(), _sentinel(), CountingPostgresqlDatabase._connect(self)))
+
+    def stats(self) -> dict:
+        with self._pool_lock:
+            return {
+                'in_use': len(self._in_use),
+                'idle': len(self._connections),
+                'waiting': self._waiting,
+                'created': self.connections_created,
+                'min_size': self._min_connections,
+                'max_size': self._max_connections,
+            }
+
+# Pool settings shared by the sync, replica and async (app.db_async) pools; timeouts in seconds, DB_POOL_TIMEOUT=0 waits
+# for a free connection without a limit
+POOL_MIN_SIZE = int(getenv('DB_POOL_MIN_SIZE', 1))
+POOL_MAX_SIZE = int(getenv('DB_POOL_MAX_SIZE', 20))
+POOL_TIMEOUT = float(getenv('DB_POOL_TIMEOUT', 10))
+POOL_STALE_TIMEOUT = float(getenv('DB_POOL_STALE_TIMEOUT', 300))
+
+database = PooledDatabase(getenv('DB_URL'),
+                          min_connections=POOL_MIN_SIZE,
+                          max_connections=POOL_MAX_SIZE,
+                          timeout=POOL_TIMEOUT,
+                          stale_timeout=POOL_STALE_TIMEOUT)
+
+# Seconds a healthy replica may lag behind the primary
+REPLICA_MAX_LAG = float(getenv('DB_REPLICA_MAX_LAG', 5))
+
+class Replicas:
+    """Read-only standbys of the primary, taken round-robin among those that passed their last health check"""
+    # Replay delay in seconds; 0 when the standby has replayed everything it received (or is not a standby)
+    LAG_SQL = '''SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                             ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'''
+
+    def __init__(self, urls: list[str], max_lag: float, **pool_kwargs):
+        self.databases = [PooledDatabase(url, **pool_kwargs) for url in urls]
+        self.max_lag = max_lag
+        self.healthy = list(self.databases)
+        self._turns = itertools.count()
+
+    def choose(self) -> PooledDatabase:
+        """The next healthy replica, or None when there is none"""
+        healthy = self.healthy
+        return healthy[next(self._turns) % len(healthy)] if healthy else None
+
+    def failed(self, replica: PooledDatabase) -> None:
+        """Skip `replica` until it passes a health check again"""
+        logger.warning('Replica %d failed, reading from the primary', self.databases.index(replica))
+        self.healthy = [healthy for healthy in self.healthy if healthy is not replica]
+
+    def lag(self, replica: PooledDatabase) -> float:
+        with replica.connection_context():
+            lag, = replica.execute_sql(self.LAG_SQL).fetchone()
+        return float(lag or 0)
+
+    def check(self) -> None:
+        """Keep the replicas that answer and lag at most `max_lag` seconds behind the primary"""
+        healthy = []
+        for number, replica in enumerate(self.databases):
+            try:
+                lag = self.lag(replica)
+            except (DatabaseError, InterfaceError) as error:
+                logger.warning('Replica %d failed its health check: %s', number, error)
+                continue
+            if lag > self.max_lag:
+                logger.warning('Replica %d is %.1f s behind the primary', number, lag)
+                continue
+            healthy.append(replica)
+        self.healthy = healthy
+
+replicas = Replicas([url.strip() for url in getenv('DB_REPLICA_URLS', '').split(',') if url.strip()],
+                    max_lag=REPLICA_MAX_LAG,
+                    min_connections=0,
+                    max_connections=POOL_MAX_SIZE,
+                    timeout=POOL_TIMEOUT,
+                    stale_timeout=POOL_STALE_TIMEOUT)
+
+class RecentWrites:
+    """Resources (revision names) this process wrote to in the last `window` seconds, read from the primary meanwhile"""
+    def __init__(self, window: float):
+        self.window = window
+        self._written = {}
+        self._lock = threading.Lock()
+        self._prune_at = 1024
+
+    def add(self, names) -> None:
+        now = time.monotonic()
+        with self._lock:
+            for name in names:
+                self._written[name] = now
+            if len(self._written) >= self._prune_at:
+                self._written = {name: at for name, at in self._written.items() if at >= now - self.window}
+                self._prune_at = max(1024, 2 * len(self._written))
+
+    def any(self, names) -> bool:
+        since = time.monotonic() - self.window
+        return any(self._written.get(name, since - 1) >= since for name in names)
+
+# A replica that passed its health check shows writes older than its allowed lag
+recent_writes = RecentWrites(REPLICA_MAX_LAG)
 
 class BaseModel(SignalModel):
     """A base model that will use our Postgresql database"""
@@ -14,12 +230,29 @@ class User(BaseModel):
     username = CharField(unique=True)
     language = FixedCharField(4)
     total_score = IntegerField()
+    achievement_count = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('total_score', 'id'), False),
+            (('achievement_count', 'id'), False),
+        )
 
 class Achievement(BaseModel):
     id = AutoField(primary_key=True, index=True, unique=True)
     score = IntegerField(constraints=[Check('score > 0')])
 
-# Define achievement translations: Ru and En
+# Title and description of an achievement in one language
+class AchievementTranslation(BaseModel):
+    achievement = ForeignKeyField(Achievement, backref='translations', on_delete='CASCADE')
+    language = CharField(8)
+    title = CharField()
+    description = CharField()
+
+    class Meta:
+        primary_key = CompositeKey('achievement', 'language')
+
+# Translation tables of the first releases, one per language; create_db moves their rows into AchievementTranslation
 class AchievementRu(BaseModel):
     id = ForeignKeyField(Achievement, backref='achievement', column_name='id', primary_key=True)
     title = CharField()
@@ -36,14 +269,202 @@ class UserAchievement(BaseModel):
     achievement = ForeignKeyField(Achievement, backref='achievement')
     date = DateTimeField()
 
+    class Meta:
+        indexes = (
+            # Keyset pages of a user's grants by date
+            (('user', 'date', 'id'), False),
+            # Duplicate checks of batch grants; not unique, an achievement can be granted again (e.g. daily)
+            (('user', 'achievement'), False),
+        )
+
+# Length of the run of consecutive active days ending at last_active_day, kept up to date on every grant
+class UserStreak(BaseModel):
+    user = ForeignKeyField(User, backref='streak', primary_key=True)
+    current_streak = IntegerField()
+    last_active_day = DateField()
+
+    class Meta:
+        indexes = (
+            (('last_active_day', 'current_streak'), False),
+        )
+
+# Grants and score of a user per day, kept up to date on every grant, for statistics over a window of days
+class UserActivity(BaseModel):
+    user = ForeignKeyField(User, backref='activity')
+    day = DateField()
+    grants = IntegerField()
+    score = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey('user', 'day')
+        indexes = (
+            # Windowed statistics of every user, read from the days of the window only (index-only)
+            (('day', 'user', 'score', 'grants'), False),
+        )
+
+# Version of a cached resource ('catalog', 'user:<id>'), bumped in the same transaction as every write that changes it
+class Revision(BaseModel):
+    name = CharField(primary_key=True)
+    version = IntegerField()
+    updated_at = DateTimeField()
+
+# Migrations applied to the database, see app.migrations
+class SchemaVersion(BaseModel):
+    version = IntegerField(primary_key=True)
+    description = CharField()
+    applied_at = DateTimeField()
+
+def user_revision(user_id: int) -> str:
+    return f'user:{user_id}'
+
+CATALOG_REVISION = 'catalog'
+
+def bump_revisions_query(*names: str):
+    """Upsert creating each named revision at version 1 or incrementing it"""
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    if replicas.databases:
+        recent_writes.add(names)
+    return (Revision
+            .insert_many([(name, 1, now) for name in sorted(set(names))], fields=[Revision.name, Revision.version, Revision.updated_at])
+            .on_conflict(conflict_target=[Revision.name],
+                         update={Revision.version: Revision.version + 1, Revision.updated_at: EXCLUDED.updated_at}))
+
+def bump_revisions(*names: str) -> None:
+    if names:
+        bump_revisions_query(*names).execute()
+
+def recount_streaks_sql(user_ids: list[int] = None) -> tuple[str, list]:
+    """Recompute current streaks from the grant history (gaps-and-islands), for `user_ids` or every user"""
+    user_filter = 'WHERE user_id = ANY(%s)' if user_ids is not None else ''
+    return f'''
+        INSERT INTO {UserStreak._meta.table_name} (user_id, current_streak, last_active_day)
+        SELECT DISTINCT ON (user_id) user_id, COUNT(*), MAX(day)
+        FROM (
+            SELECT user_id, day, day - (ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY day))::int AS island
+            FROM (SELECT DISTINCT user_id, date::date AS day FROM {UserAchievement._meta.table_name} {user_filter}) AS days
+        ) AS islands
+        GROUP BY user_id, island
+        ORDER BY user_id, MAX(day) DESC
+        ON CONFLICT (user_id) DO UPDATE
+        SET current_streak = EXCLUDED.current_streak, last_active_day = EXCLUDED.last_active_day
+    ''', [list(user_ids)] if user_ids is not None else []
+
+def recount_streaks(user_ids: list[int] = None) -> None:
+    database.execute_sql(*recount_streaks_sql(user_ids))
+
+def recount_activity_query():
+    """Insert the daily activity of every user from the grant history, into an empty UserActivity"""
+    day = UserAchievement.date.cast('date')
+    return UserActivity.insert_from(
+        (UserAchievement
+         .select(UserAchievement.user, day, fn.COUNT(UserAchievement.id), fn.SUM(Achievement.score))
+         .join(Achievement)
+         .group_by(UserAchievement.user, day)),
+        fields=[UserActivity.user, UserActivity.day, UserActivity.grants, UserActivity.score]).returning()
+
+def recount_activity() -> None:
+    UserActivity.delete().execute()
+    recount_activity_query().execute()
+
+def score_drift_query():
+    """Users whose stored total_score or achievement_count differs from their granted achievements"""
+    actual_score = fn.COALESCE(fn.SUM(Achievement.score), 0)
+    actual_count = fn.COUNT(UserAchievement.id)
+    return (User
+            .select(User.id, User.total_score.alias('stored_score'), actual_score.alias('actual_score'),
+                    User.achievement_count.alias('stored_count'), actual_count.alias('actual_count'))
+            .join(UserAchievement, JOIN.LEFT_OUTER)
+            .join(Achievement, JOIN.LEFT_OUTER)
+            .group_by(User.id)
+            .having((User.total_score != actual_score) | (User.achievement_count != actual_count)))
+
+def reconcile_scores_query(report: bool = True):
+    """Update setting the drifted users' total_score and achievement_count to their actual values.
+
+    Returns the drift of each user when `report`, otherwise only the number of users updated.
+    """
+    drift = score_drift_query().alias('drift')
+    query = (User
+             .update(total_score=drift.c.actual_score, achievement_count=drift.c.actual_count)
+             .from_(drift)
+             .where(User.id == drift.c.id))
+    if report:
+        query = query.returning(*[getattr(drift.c, column) for column in ('id', 'stored_score', 'actual_score', 'stored_count', 'actual_count')])
+    return query
+
+# Channel of the change events of grants and score updates; a NOTIFY is delivered when its transaction commits
+CHANGES_CHANNEL = 'changes'
+
+def publish_changes_sql(grants: list[tuple[int, int, datetime.datetime]] = (), user_ids: list[int] = ()) -> tuple[str, list]:
+    """NOTIFY a grant event per (user_id, achievement_id, date), then a score event with the current score of each user"""
+    events, params = [], []
+    if grants:
+        events.append(f'VALUES {", ".join(["(%s::text)"] * len(grants))}')
+        params.extend(json.dumps({'type': 'grant', 'user_id': user_id, 'achievement_id': achievement_id, 'date': date.isoformat()})
+                      for user_id, achievement_id, date in grants)
+    if user_ids:
+        events.append(f'''SELECT json_build_object('type', 'score', 'user_id', id, 'total_score', total_score,
+                                                   'achievement_count', achievement_count)::text
+                          FROM "{User._meta.table_name}" WHERE id = ANY(%s)''')
+        params.append(list(user_ids))
+    return f"SELECT pg_notify('{CHANGES_CHANNEL}', payload) FROM ({' UNION ALL '.join(events)}) AS events (payload)", params
+
+def publish_changes(grants: list[tuple[int, int, datetime.datetime]] = (), user_ids: list[int] = ()) -> None:
+    if grants or user_ids:
+        database.execute_sql(*publish_changes_sql(grants, user_ids))
+
+def credit_grant_query(user_id: int, achievement_id: int):
+    """Atomic in-database increment of the user's score and achievement count by one grant"""
+    score = Achievement.select(Achievement.score).where(Achievement.id == achievement_id)
+    return (User
+            .update(total_score=User.total_score + score, achievement_count=User.achievement_count + 1)
+            .where(User.id == user_id))
+
+def extend_streak_query(user_id: int, day: datetime.date):
+    """Upsert extending the user's streak by `day`; inserts nothing when `day` is older than the last active day"""
+    # The day offset is an SQL literal, so `date - 1` is typed the same by drivers that bind server-side
+    return (UserStreak
+            .insert(user=user_id, current_streak=1, last_active_day=day)
+            .on_conflict(conflict_target=[UserStreak.user],
+                         update={UserStreak.current_streak: Case(None, [
+                                     (UserStreak.last_active_day == EXCLUDED.last_active_day, UserStreak.current_streak),
+                                     (UserStreak.last_active_day == EXCLUDED.last_active_day - SQL('1'), UserStreak.current_streak + 1)],
+                                     1),
+                                 UserStreak.last_active_day: EXCLUDED.last_active_day},
+                         where=(UserStreak.last_active_day <= EXCLUDED.last_active_day)))
+
+def record_activity_query(user_id: int, achievement_id: int, day: datetime.date):
+    """Upsert adding one grant of the achievement to the user's activity of `day`"""
+    score = Achievement.select(Achievement.score).where(Achievement.id == achievement_id)
+    return (UserActivity
+            .insert(user=user_id, day=day, grants=1, score=score)
+            .on_conflict(conflict_target=[UserActivity.user, UserActivity.day],
+                         update={UserActivity.grants: UserActivity.grants + EXCLUDED.grants,
+                                 UserActivity.score: UserActivity.score + EXCLUDED.score}))
+
+@post_save(sender=UserAchievement)
+def increment_user_score(sender, instance, created):
+    # Applied in the grant's transaction
+    if created:
+        credit_grant_query(instance.user_id, instance.achievement_id).execute()
+        bump_revisions(user_revision(instance.user_id))
+
+@post_save(sender=UserAchievement)
+def extend_user_streak(sender, instance, created):
+    if not created:
+        return
+    extended = extend_streak_query(instance.user_id, instance.date.date()).execute()
+    if extended is None:
+        # Backdated grant: it may join older runs of days, so recount from history
+        recount_streaks([instance.user_id])
+
+@post_save(sender=UserAchievement)
+def record_user_activity(sender, instance, created):
+    if created:
+        record_activity_query(instance.user_id, instance.achievement_id, instance.date.date()).execute()
+
 @post_save(sender=UserAchievement)
-def recount_user_score(sender, instance, created):
+def publish_grant(sender, instance, created):
+    # After the credit, so the score event carries the new score
     if created:
-        user = instance.user
-        total_score = (UserAchievement
-                       .select(fn.SUM(Achievement.score))
-                       .join(Achievement)
-                       .where(UserAchievement.user == user)
-                       .scalar())
-        user.total_score = total_score
-        user.save()
+        publish_changes([(instance.user_id, instance.achievement_id, instance.date)], [instance.user_id])
@@ -0,0 +1,321 @@
+"""Async counterpart of `db_functions` on an asyncpg pool, used by the routes when DB_BACKEND=async.
+
+Statements come from the same peewee query builders as the sync functions, compiled to asyncpg's
+`$n` placeholders, so both backends send identical SQL. The achievement cache is shared with `db_functions`.
+"""
+import datetime
+import itertools
+import re
+import time
+from contextlib import asynccontextmanager
+from os import getenv
+
+import asyncpg
+from peewee import chunked
+
+from app.db import (User, Achievement, AchievementTranslation, UserAchievement, bump_revisions_query, recount_streaks_sql, credit_grant_query,
+                    extend_streak_query, record_activity_query, publish_changes_sql, user_revision, record_query, CATALOG_REVISION,
+                    POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_TIMEOUT, POOL_STALE_TIMEOUT)
+from app.db_functions import (Lang, Language, GrantStatus, GrantPlan, GRANT_BATCH_SIZE, LANGUAGES, CATALOG_KEY,
+                              achievement_cache, check_catalog_version, statistics_changed, achievements_query, cache_achievements, lookup_achievements,
+                              missing_achievements_query, cache_catalog, localize_all, translation_upsert_query,
+                              revisions_query, credit_users_query, grant_lookup_queries, insert_grants_query,
+                              max_achievements_query, max_score_query, min_score_diff_query, max_score_diff_query,
+                              users_query, pair_users, grants_query, build_profiles, streak_query, leaderboard_query,
+                              rank_counts_query, rank_page, encode_leaderboard_cursor, user_rank_query, rank_totals,
+                              decode_achievement_cursor, catalog_page_ids, achievements_page_query, achievements_page,
+                              user_grants_query, grants_page, record_activities_query, top_scorers_query,
+                              user_activity_query, scorer_users)
+
+pool: asyncpg.Pool = None
+
+async def connect() -> None:
+    """Open the pool, sized by the same DB_POOL_* settings as the sync one"""
+    global pool
+    pool = await asyncpg.create_pool(getenv('DB_URL'),
+                                     min_size=POOL_MIN_SIZE,
+                                     max_size=POOL_MAX_SIZE,
+                                     max_inactive_connection_lifetime=POOL_STALE_TIMEOUT)
+
+async def close() -> None:
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+
+def stats() -> dict:
+    return {
+        'in_use': pool.get_size() - pool.get_idle_size(),
+        'idle': pool.get_idle_size(),
+        'min_size': pool.get_min_size(),
+        'max_size': pool.get_max_size(),
+    }
+
+@asynccontextmanager
+async def connection():
+    # DB_POOL_TIMEOUT=0 waits without a limit, as in the sync pool
+    async with pool.acquire(timeout=POOL_TIMEOUT or None) as conn:
+        yield conn
+
+@asynccontextmanager
+async def transaction():
+    async with connection() as conn, conn.transaction():
+        yield conn
+
+_PLACEHOLDER = re.compile(r'%([s%])')
+
+def compile(query) -> tuple[str, list]:
+    """SQL and parameters of a peewee query, or of a raw (sql, params) pair, with asyncpg placeholders"""
+    sql, params = query if isinstance(query, tuple) else query.sql()
+    numbers = itertools.count(1)
+    return _PLACEHOLDER.sub(lambda match: f'${next(numbers)}' if match.group(1) == 's' else '%', sql), list(params or [])
+
+async def run(method, query):
+    """Await a connection method (fetch, execute, ...) on a compiled query, accounting it like the sync backend does"""
+    sql, params = compile(query)
+    start = time.perf_counter()
+    try:
+        return await method(sql, *params)
+    finally:
+        record_query(sql, params, time.perf_counter() - start)
+
+async def fetch(conn, query) -> list:
+    return await run(conn.fetch, query)
+
+async def fetchrow(conn, query):
+    return await run(conn.fetchrow, query)
+
+async def fetchval(conn, query):
+    return await run(conn.fetchval, query)
+
+async def execute(conn, query) -> None:
+    await run(conn.execute, query)
+
+def hydrate(query, record):
+    """Model instance for a record of a model select, with joined models attached like peewee does"""
+    attrs = {dest: attr for dest, attr, *_ in query._joins.get(query.model, [])}
+    values = {}
+    for field, value in zip(query._returning, record):
+        values.setdefault(field.model, {})[field.name] = field.python_value(value)
+    instance = query.model(**values.pop(query.model))
+    for model, fields in values.items():
+        # LEFT JOIN without a match: leave the attribute unset
+        if any(value is not None for value in fields.values()):
+            setattr(instance, attrs[model], model(**fields))
+    return instance
+
+async def fetch_models(conn, query) -> list:
+    return [hydrate(query, record) for record in await fetch(conn, query)]
+
+async def create_user(username: str, language: Language) -> int:
+    try:
+        async with transaction() as conn:
+            user_id = await fetchval(conn, User.insert(username=username, language=language.value, total_score=0))
+            await execute(conn, bump_revisions_query(user_revision(user_id)))
+            return user_id
+    finally:
+        statistics_changed()
+
+async def get_user(user_id: int) -> User:
+    async with connection() as conn:
+        users = await fetch_models(conn, User.select().where(User.id == user_id))
+    if not users:
+        raise User.DoesNotExist(f'User {user_id} does not exist')
+    return users[0]
+
+async def get_user_language(user_id: int) -> Language:
+    return (await get_user(user_id)).language
+
+async def create_achievement(score: int) -> int:
+    try:
+        async with transaction() as conn:
+            achievement_id = await fetchval(conn, Achievement.insert(score=score))
+            await execute(conn, bump_revisions_query(CATALOG_REVISION))
+        return achievement_id
+    finally:
+        achievement_cache.invalidate(CATALOG_KEY)
+        statistics_changed()
+
+async def translate_achievement(id: int, language: Language, title: str, description: str) -> tuple[AchievementTranslation, bool]:
+    try:
+        async with transaction() as conn:
+            created = await fetchval(conn, translation_upsert_query(id, language, title, description))
+            await execute(conn, bump_revisions_query(CATALOG_REVISION))
+        return AchievementTranslation(achievement=id, language=Lang(language).value, title=title, description=description), created
+    finally:
+        achievement_cache.invalidate(*[(id, lang) for lang in LANGUAGES])
+        statistics_changed()
+
+async def cached_achievements(conn, achievement_ids) -> dict:
+    entries, missing = lookup_achievements(achievement_ids)
+    if missing:
+        query = missing_achievements_query(missing)
+        generation = achievement_cache.generation
+        entries.update(cache_achievements(await fetch_models(conn, query), generation))
+    return entries
+
+async def load_achievements(conn, language: Language, achievement_ids: list[int] = None) -> list[tuple[Achievement, list]]:
+    if achievement_ids is None:
+        achievement_ids = achievement_cache.get(CATALOG_KEY)
+        if achievement_ids is None:
+            generation = achievement_cache.generation
+            achievement_ids = cache_catalog(cache_achievements(await fetch_models(conn, achievements_query(Lang.ALL)), generation), generation)
+    return localize_all(await cached_achievements(conn, achievement_ids), language)
+
+async def get_translation(id: int, language: Language):
+    async with connection() as conn:
+        achievements = await load_achievements(conn, language, [id])
+    return achievements[0][1] if achievements else None
+
+async def get_revisions(names: list[str]) -> dict[str, tuple[int, datetime.datetime]]:
+    async with connection() as conn:
+        versions = {name: (version, updated_at) for name, version, updated_at in await fetch(conn, revisions_query(names))}
+    if CATALOG_REVISION in names:
+        check_catalog_version(versions)
+    return versions
+
+async def get_achievement(id: int, language: Language) -> tuple[Achievement, list]:
+    async with connection() as conn:
+        achievements = await load_achievements(conn, language, [id])
+    if not achievements:
+        raise Achievement.DoesNotExist(f'Achievement {id} does not exist')
+    return achievements[0]
+
+async def get_achievements(language: Language) -> list[tuple[Achievement, list]]:
+    async with connection() as conn:
+        return await load_achievements(conn, language)
+
+async def get_achievements_page(language: Language, limit: int, after: str = None) -> tuple[list[tuple[Achievement, list]], str]:
+    after_id = decode_achievement_cursor(after) if after else 0
+    page_ids = catalog_page_ids(after_id, limit)
+    async with connection() as conn:
+        if page_ids is None:
+            generation = achievement_cache.generation
+            entries = cache_achievements(await fetch_models(conn, achievements_page_query(after_id, limit)), generation)
+        else:
+            entries = await cached_achievements(conn, page_ids)
+    return achievements_page(entries, list({achievement_id for achievement_id, _ in entries}), limit, language)
+
+async def get_user_achievements_page(user_id: int, limit: int, after: str = None, descending: bool = False) -> tuple[list[tuple], str]:
+    query = user_grants_query(user_id, limit, after, descending)
+    user = await get_user(user_id)
+    async with connection() as conn:
+        grants = [tuple(grant) for grant in await fetch(conn, query)]
+        entries = await cached_achievements(conn, [achievement_id for _, achievement_id, _ in grants[:limit]])
+    return grants_page(user, grants, entries, limit)
+
+async def grant_user_achievement(user_id: int, achievement_id: int, date: datetime.datetime = None) -> None:
+    # The same statements as the UserAchievement post_save signals of the sync backend
+    date = date or datetime.datetime.now()
+    try:
+        async with transaction() as conn:
+            await execute(conn, UserAchievement.insert(user=user_id, achievement=achievement_id, date=date))
+            await execute(conn, credit_grant_query(user_id, achievement_id))
+            await execute(conn, bump_revisions_query(user_revision(user_id)))
+            if await fetchval(conn, extend_streak_query(user_id, date.date())) is None:
+                await execute(conn, recount_streaks_sql([user_id]))
+            await execute(conn, record_activity_query(user_id, achievement_id, date.date()))
+            await execute(conn, publish_changes_sql([(user_id, achievement_id, date)], [user_id]))
+    finally:
+        statistics_changed()
+
+async def grant_user_achievements(grants: list[tuple[int, int, datetime.datetime]], skip_duplicates: bool = False) -> list[GrantStatus]:
+    plan = GrantPlan(skip_duplicates)
+    try:
+        async with transaction() as conn:
+            for chunk in chunked(grants, GRANT_BATCH_SIZE):
+                users, scores, existing = grant_lookup_queries(chunk, skip_duplicates)
+                rows = plan.rows(chunk, {user_id for user_id, in await fetch(conn, users)},
+                                 {achievement_id: score for achievement_id, score in await fetch(conn, scores)},
+                                 {tuple(pair) for pair in await fetch(conn, existing)} if existing is not None else set())
+                if rows:
+                    await execute(conn, insert_grants_query(rows))
+                    await execute(conn, publish_changes_sql(rows))
+            if plan.deltas:
+                await execute(conn, credit_users_query(plan.deltas))
+                await execute(conn, bump_revisions_query(*[user_revision(user_id) for user_id in plan.deltas]))
+                await execute(conn, recount_streaks_sql(list(plan.deltas)))
+                for activity in chunked(plan.activity.items(), GRANT_BATCH_SIZE):
+                    await execute(conn, record_activities_query(dict(activity)))
+                await execute(conn, publish_changes_sql(user_ids=list(plan.deltas)))
+    finally:
+        statistics_changed()
+    return plan.statuses
+
+async def get_user_achievements(user_id: int) -> list:
+    async with connection() as conn:
+        return [achievement_id for _, achievement_id in await fetch(conn, grants_query([user_id]))]
+
+async def get_achievements_translations(achievement_ids: list[int], language: Language) -> list:
+    async with connection() as conn:
+        translations = dict((achievement.id, translation) for achievement, translation in await load_achievements(conn, language, achievement_ids))
+    return [translations.get(achievement_id) for achievement_id in achievement_ids]
+
+async def get_user_with_max_achievements() -> tuple[User, int]:
+    async with connection() as conn:
+        users = await fetch_models(conn, max_achievements_query())
+    if not users:
+        raise User.DoesNotExist('There are no users')
+    return users[0], users[0].achievement_count
+
+async def get_user_with_max_score() -> User:
+    async with connection() as conn:
+        users = await fetch_models(conn, max_score_query())
+    if not users:
+        raise User.DoesNotExist('There are no users')
+    return users[0]
+
+async def get_users_with_min_score_diff(limit: int = None) -> list[tuple[User, User, int]]:
+    async with connection() as conn:
+        pairs = await fetch(conn, min_score_diff_query(limit))
+        query = users_query([user_id for pair in pairs for user_id in pair[:2]])
+        return pair_users(pairs, await fetch_models(conn, query))
+
+async def get_users_with_max_score_diff() -> list[User]:
+    query = max_score_diff_query()
+    async with connection() as conn:
+        return [User(**{field.name: field.python_value(value) for field, value in zip(User._meta.sorted_fields, record)})
+                for record in await fetch(conn, query)]
+
+async def get_users_profiles(user_ids: list[int]) -> dict[int, tuple[User, list[tuple[Achievement, list]]]]:
+    async with connection() as conn:
+        users = await fetch_models(conn, users_query(user_ids))
+        if not users:
+            return {}
+        grants = [tuple(grant) for grant in await fetch(conn, grants_query([user.id for user in users]))]
+        return build_profiles(users, grants, await cached_achievements(conn, [achievement_id for _, achievement_id in grants]))
+
+async def get_users_achievements(users: list[int]) -> dict:
+    return {user_id: ([achievement.id for achievement, _ in achievements], user.total_score)
+            for user_id, (user, achievements) in (await get_users_profiles(users)).items()}
+
+async def get_users_with_streak(day_streak: int = 7, limit: int = 100) -> list:
+    async with connection() as conn:
+        return await fetch_models(conn, streak_query(day_streak, limit))
+
+async def get_top_scorers(days: int, limit: int = 10) -> list[tuple[User, int, int]]:
+    async with connection() as conn:
+        scorers = await fetch(conn, top_scorers_query(days, limit))
+        query = users_query([user_id for user_id, _, _ in scorers])
+        return scorer_users(scorers, await fetch_models(conn, query))
+
+async def get_user_activity(user_id: int, days: int) -> list[tuple[datetime.date, int, int]]:
+    await get_user(user_id)
+    async with connection() as conn:
+        return [tuple(day) for day in await fetch(conn, user_activity_query(user_id, days))]
+
+async def get_leaderboard(limit: int = 20, after: str = None) -> tuple[list[tuple[int, User]], str]:
+    query = leaderboard_query(limit, after)
+    async with connection() as conn:
+        users = await fetch_models(conn, query)
+        page, users = users[:limit], users[limit:]
+        if not page:
+            return [], None
+        higher, tied_before = await fetchrow(conn, rank_counts_query(page[0]))
+    return rank_page(page, higher, tied_before), encode_leaderboard_cursor(page[-1]) if users else None
+
+async def get_user_rank(user_id: int) -> tuple[User, int, int, int]:
+    user = await get_user(user_id)
+    async with connection() as conn:
+        higher, lower, total = rank_totals(*await fetchrow(conn, user_rank_query(user)))
+    return user, higher + 1, lower, total
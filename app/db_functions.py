@@ -1,10 +1,19 @@
+import base64
+import bisect
 import functools
 import datetime
+import itertools
+import json
+from contextlib import contextmanager
+from contextvars import ContextVar
 from enum import Enum
-from typing import NewType
-from peewee import fn
+from os import getenv
+from typing import Iterable, Iterator, NewType
+from peewee import InterfaceError, OperationalError, fn, Cast, JOIN, EXCLUDED, SQL, Select, Tuple, ValuesList, chunked
 
-from app.db import database, User, Achievement, AchievementRu, AchievementEn, UserAchievement
+from app.cache import LRUCache
+from app.migrations import LEGACY_TRANSLATION_MODELS, apply_migrations
+from app.db import database, User, Achievement, AchievementTranslation, UserAchievement, UserStreak, UserActivity, Revision, SchemaVersion, replicas, recent_writes, recount_streaks, recount_activity, score_drift_query, reconcile_scores_query, publish_changes, bump_revisions, user_revision, CATALOG_REVISION
 
 class Lang(Enum):
     EN = 'en'
@@ -13,169 +22,893 @@ class Lang(Enum):
 
 Language = NewType('Language', Lang)
 
+class GrantStatus(Enum):
+    GRANTED = 'granted'
+    DUPLICATE = 'duplicate'
+    UNKNOWN_USER = 'unknown_user'
+    UNKNOWN_ACHIEVEMENT = 'unknown_achievement'
+
+GRANT_BATCH_SIZE = 1000
+# Rows per multi-row insert of an import, and per round-trip of an export's server-side cursor
+IMPORT_BATCH_SIZE = 1000
+EXPORT_BATCH_SIZE = 2000
+
+# (achievement_id, Lang) -> (Achievement, translation or None), plus CATALOG_KEY -> ids of every achievement.
+# Invalidated by writes made through this process, and cleared by `check_catalog_version` after those of other processes.
+achievement_cache = LRUCache(int(getenv('ACHIEVEMENT_CACHE_SIZE', 10000)))
+CATALOG_KEY = 'catalog'
+# Catalog revision last read by `get_revisions`, which the achievement cache is not older than
+catalog_version = None
+
+def check_catalog_version(versions: dict[str, tuple[int, datetime.datetime]]) -> None:
+    """Clear the achievement cache when the catalog revision read from the database moved since the last read"""
+    global catalog_version
+    version, _ = versions.get(CATALOG_REVISION, (None, None))
+    if version != catalog_version:
+        achievement_cache.clear()
+        catalog_version = version
+
+# Bumped by every write of this process that can change the statistics (users, grants, achievements and their translations)
+statistics_version = 0
+
+def statistics_changed() -> None:
+    global statistics_version
+    statistics_version += 1
+
+# Languages achievements are translated to, in the order translations are returned for Lang.ALL
+LANGUAGES = [lang for lang in Lang if lang is not Lang.ALL]
+# Shown when an achievement has no translation in the requested language
+FALLBACK_LANGUAGE = Lang.EN
+
+def translation_language(language: Language) -> Lang:
+    language = Lang(language)
+    if language not in LANGUAGES:
+        raise ValueError(f'Unsupported translation language {language.value!r}')
+    return language
+
+def translation_fallbacks(language: Language) -> list[Lang]:
+    """Languages tried in turn for a translation to `language`"""
+    language = Lang(language)
+    return [language] if language is FALLBACK_LANGUAGE else [language, FALLBACK_LANGUAGE]
+
+def db_connection(func):
+    """Run `func` on the connection held by the current request, or check one out of the pool for the call"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not database.is_closed():
+            return func(*args, **kwargs)
+        with database.connection_context():
+            return func(*args, **kwargs)
+    return wrapper
+
+# Set while a read runs on a replica, so that the reads it nests stay there
+_on_replica: ContextVar[bool] = ContextVar('on_replica', default=False)
+
+@contextmanager
+def replica_connection(replica):
+    """Run the statements of the current context on a pooled connection of `replica` instead of the primary"""
+    state = database._state
+    saved = {name: getattr(state, name) for name in ('conn', 'closed', 'ctx', 'transactions')}
+    replica.connect()
+    token = _on_replica.set(True)
+    try:
+        state.conn, state.closed, state.ctx, state.transactions = replica.connection(), False, [], []
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(state, name, value)
+        _on_replica.reset(token)
+        replica.close()
+
+# `read_from` of the connection state inside `pinned_reads`, until the first `db_read` picks a database
+_UNPINNED = object()
+
+@contextmanager
+def pinned_reads():
+    """Serve every `db_read` of the current context (an HTTP request) from the database the first one picked.
+
+    A response then never mixes replicas, e.g. an ETag read from an up-to-date replica with a body from a lagging one.
+    Once a read went to the primary, the following ones stay there: the primary is never behind what was read before.
+    """
+    database._state.read_from = _UNPINNED
+    try:
+        yield
+    finally:
+        database._state.read_from = None
+
+def db_read(resources=lambda *args, **kwargs: []):
+    """Like `db_connection`, but runs a read-only `func` on a replica when DB_REPLICA_URLS is set.
+
+    Stays on the primary inside a transaction, and when this process wrote to one of the `resources(*args, **kwargs)`
+    revisions recently enough for a replica to miss it (read-your-writes). A failing replica is skipped until its
+    next health check and the read is retried on the primary. Within `pinned_reads`, reads keep to one database.
+    """
+    def decorator(func):
+        on_primary = db_connection(func)
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _on_replica.get() or not replicas.databases or database.in_transaction():
+                return on_primary(*args, **kwargs)
+            pinned = getattr(database._state, 'read_from', None)
+            if pinned is database or recent_writes.any(resources(*args, **kwargs)):
+                replica = None
+            elif pinned is None or pinned is _UNPINNED:
+                replica = replicas.choose()
+            else:
+                replica = pinned
+            if pinned is not None:
+                database._state.read_from = replica or database
+            if replica is None:
+                return on_primary(*args, **kwargs)
+            try:
+                with replica_connection(replica):
+                    return func(*args, **kwargs)
+            except (OperationalError, InterfaceError):
+                replicas.failed(replica)
+                if pinned is not None:
+                    database._state.read_from = database
+                return on_primary(*args, **kwargs)
+        return wrapper
+    return decorator
+
 def db_transaction(func):
+    """Like `db_connection`, but wraps `func` in a transaction (a savepoint when nested)"""
     @functools.wraps(func)
+    @db_connection
     def wrapper(*args, **kwargs):
-        database.connect()
-        res = func(*args, **kwargs)
-        database.close()
-        return res
+        with database.atomic():
+            return func(*args, **kwargs)
     return wrapper
 
+def changes_statistics(func):
+    """Call `statistics_changed` once the wrapped write has finished"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            statistics_changed()
+    return wrapper
+
+def invalidates_cache(keys):
+    """Drop `keys(*args, **kwargs)` from `achievement_cache` once the wrapped write has finished"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                achievement_cache.invalidate(*keys(*args, **kwargs))
+        return wrapper
+    return decorator
+
 
 def create_db():
-    with database:
-        database.create_tables([User, Achievement, AchievementRu, AchievementEn, UserAchievement])
+    """Create the schema or bring it up to date, see `app.migrations`"""
+    achievement_cache.clear()
+    statistics_changed()
+    apply_migrations()
 
 def drop_db():
+    achievement_cache.clear()
+    statistics_changed()
     with database:
-        database.drop_tables([User, Achievement, AchievementRu, AchievementEn, UserAchievement])
+        database.drop_tables([User, Achievement, AchievementTranslation, *LEGACY_TRANSLATION_MODELS.values(),
+                              UserAchievement, UserStreak, UserActivity, Revision, SchemaVersion])
     
+@changes_statistics
 @db_transaction
 def create_user(username: str, language: Language) -> int:
     new_user = User.create(username=username, language=language.value, total_score=0)
+    # Read-your-writes: the new user is read from the primary until the replicas have it
+    bump_revisions(user_revision(new_user.id))
     return new_user.id
 
-@db_transaction
+@db_read(lambda user_id, *args, **kwargs: [user_revision(user_id)])
 def get_user(user_id: int) -> User:
     user = User.get_by_id(user_id)
     return user
 
-@db_transaction
+@db_read(lambda user_id, *args, **kwargs: [user_revision(user_id)])
 def get_user_language(user_id: int) -> Language:
     user = User.get_by_id(user_id)
     return user.language
 
+@changes_statistics
+@invalidates_cache(lambda *args, **kwargs: [CATALOG_KEY])
 @db_transaction
 def create_achievement(score: int) -> int:
     achievement = Achievement.create(score=score)
+    bump_revisions(CATALOG_REVISION)
     return achievement.id
 
+@changes_statistics
+@invalidates_cache(lambda id, *args, **kwargs: [(id, lang) for lang in LANGUAGES])
 @db_transaction
-def translate_achievement(id: int, language: Language, title: str, description: str) -> tuple[Achievement, bool]:
-    match(language):
-        case Lang.EN:
-            translation, created = AchievementEn.get_or_create(id=id, defaults={'title': title, 'description': description})
-        case Lang.RU:
-            translation, created = AchievementRu.get_or_create(id=id, defaults={'title': title, 'description': description})
-    if created:
-        translation.update(title=title, description=description)
-    return translation, created
+def translate_achievement(id: int, language: Language, title: str, description: str) -> tuple[AchievementTranslation, bool]:
+    (created,), = translation_upsert_query(id, language, title, description).tuples().execute()
+    bump_revisions(CATALOG_REVISION)
+    return AchievementTranslation(achievement=id, language=Lang(language).value, title=title, description=description), created
+
+def translation_upsert_query(id: int, language: Language, title: str, description: str):
+    """Insert or overwrite one translation, returning whether it was inserted"""
+    return (AchievementTranslation
+            .insert(achievement=id, language=translation_language(language).value, title=title, description=description)
+            .on_conflict(conflict_target=[AchievementTranslation.achievement, AchievementTranslation.language],
+                         update={AchievementTranslation.title: EXCLUDED.title,
+                                 AchievementTranslation.description: EXCLUDED.description})
+            # xmax is only set on the row version written by the update branch
+            .returning(SQL('(xmax = 0)').alias('created')))
 
 def get_translation(id: int, language: Language):
-    match(Lang(language)):
-        case Lang.EN:
-            translation = AchievementEn.get_or_none(id=id)
-        case Lang.RU:
-            translation = AchievementRu.get_or_none(id=id)
-        case Lang.ALL:
-            translation = [AchievementEn.get_or_none(id=id), AchievementRu.get_or_none(id=id)]
-    return translation
+    achievements = load_achievements(language, [id])
+    return achievements[0][1] if achievements else None
 
-@db_transaction
+def achievements_query(language: Language):
+    """Achievements LEFT JOINed with their translations to `language` and its fallbacks (or every language),
+    one row per translation, over the (achievement, language) primary key"""
+    language = Lang(language)
+    on = AchievementTranslation.achievement == Achievement.id
+    if language is not Lang.ALL:
+        on &= AchievementTranslation.language.in_([lang.value for lang in translation_fallbacks(language)])
+    return (Achievement
+            .select(Achievement, AchievementTranslation)
+            .join(AchievementTranslation, JOIN.LEFT_OUTER, on=on, attr='translation')
+            .order_by(Achievement.id))
+
+def cache_achievements(rows, generation: int) -> dict:
+    """Store every (achievement, language) entry of the rows of an `achievements_query(Lang.ALL)`, unless the cache
+    was invalidated since `generation`, read from it before querying the rows"""
+    entries = {}
+    for row in rows:
+        for lang in LANGUAGES:
+            entries.setdefault((row.id, lang), (row, None))
+        translation = getattr(row, 'translation', None)
+        if translation is not None:
+            entries[(row.id, Lang(translation.language))] = (row, translation)
+    achievement_cache.set_many(entries, generation)
+    return entries
+
+def cached_achievements(achievement_ids) -> dict:
+    """(achievement_id, Lang) -> (Achievement, translation) for every language, fetching cache misses in one query"""
+    entries, missing = lookup_achievements(achievement_ids)
+    if missing:
+        # The query runs lazily, after the generation is read
+        entries.update(cache_achievements(missing_achievements_query(missing), achievement_cache.generation))
+    return entries
+
+def lookup_achievements(achievement_ids) -> tuple[dict, list[int]]:
+    """Cached entries for `achievement_ids` and the ids that have to be fetched"""
+    keys = [(achievement_id, lang) for achievement_id in set(achievement_ids) for lang in LANGUAGES]
+    entries = achievement_cache.get_many(keys)
+    missing = {achievement_id for achievement_id, lang in keys if (achievement_id, lang) not in entries}
+    return entries, sorted(missing)
+
+def missing_achievements_query(achievement_ids: list[int]):
+    return achievements_query(Lang.ALL).where(Achievement.id.in_(achievement_ids))
+
+def cache_catalog(entries: dict, generation: int) -> list[int]:
+    """Remember the ids of the whole catalog, given the entries of `cache_achievements` over every achievement"""
+    achievement_ids = sorted({achievement_id for achievement_id, _ in entries})
+    achievement_cache.set(CATALOG_KEY, achievement_ids, generation)
+    return achievement_ids
+
+def localize_all(entries: dict, language: Language) -> list[tuple[Achievement, list]]:
+    return [localize(entries, achievement_id, language) for achievement_id in sorted({achievement_id for achievement_id, _ in entries})]
+
+def localize(entries: dict, achievement_id: int, language: Language) -> tuple[Achievement, list]:
+    """(achievement, translation) shaped like `get_translation`, from `cached_achievements` entries: the first existing
+    translation of the fallback chain of `language`, or the list of every existing translation for Lang.ALL"""
+    language = Lang(language)
+    achievement = entries[(achievement_id, LANGUAGES[0])][0]
+    if language is Lang.ALL:
+        return achievement, [translation for lang in LANGUAGES if (translation := entries[(achievement_id, lang)][1])]
+    translations = (entries[(achievement_id, lang)][1] for lang in translation_fallbacks(language))
+    return achievement, next((translation for translation in translations if translation), None)
+
+def load_achievements(language: Language, achievement_ids: list[int] = None) -> list[tuple[Achievement, list]]:
+    """(achievement, translation) pairs ordered by id, for `achievement_ids` or the whole catalog"""
+    if achievement_ids is None:
+        achievement_ids = achievement_cache.get(CATALOG_KEY)
+        if achievement_ids is None:
+            generation = achievement_cache.generation
+            achievement_ids = cache_catalog(cache_achievements(achievements_query(Lang.ALL), generation), generation)
+    return localize_all(cached_achievements(achievement_ids), language)
+
+def revisions_query(names: list[str]):
+    return Revision.select(Revision.name, Revision.version, Revision.updated_at).where(Revision.name.in_(names))
+
+@db_read(lambda names: names)
+def get_revisions(names: list[str]) -> dict[str, tuple[int, datetime.datetime]]:
+    """(version, updated_at in UTC) for each named resource that has been written to"""
+    versions = {name: (version, updated_at) for name, version, updated_at in revisions_query(names).tuples()}
+    if CATALOG_REVISION in names:
+        # The cached achievements are read after the revisions, so they are never older than the ETag they get
+        check_catalog_version(versions)
+    return versions
+
+@db_read(lambda *args, **kwargs: [CATALOG_REVISION])
 def get_achievement(id: int, language: Language) -> tuple[Achievement, list]:
-    achievement = Achievement.get_by_id(id)
-    translation = get_translation(id, language)
-    return achievement, translation
+    achievements = load_achievements(language, [id])
+    if not achievements:
+        raise Achievement.DoesNotExist(f'Achievement {id} does not exist')
+    return achievements[0]
 
-def get_achievements(language=Language):
-    with database:
-        achievements_query = Achievement.select()
-        achievements_list = []
-        for achievement in achievements_query:
-            achievements_list.append((achievement, get_translation(achievement.id, language)))
-    return achievements_list
+@db_read(lambda *args, **kwargs: [CATALOG_REVISION])
+def get_achievements(language: Language) -> list[tuple[Achievement, list]]:
+    return load_achievements(language)
 
+@changes_statistics
 @db_transaction
-def grant_user_achievement(user_id: int, achievement_id: int, date: datetime.datetime = datetime.datetime.now()) -> None:
-    UserAchievement.create(user_id=user_id, achievement_id=achievement_id, date=date)
+def grant_user_achievement(user_id: int, achievement_id: int, date: datetime.datetime = None) -> None:
+    UserAchievement.create(user_id=user_id, achievement_id=achievement_id, date=date or datetime.datetime.now())
+
+def credit_users_query(deltas: dict[int, tuple[int, int]]):
+    """Add (score, achievement count) deltas to several users with a single UPDATE ... FROM (VALUES ...)"""
+    # Typed first row, so the VALUES columns are integers for drivers that bind parameters server-side
+    credit = ValuesList([(Cast(user_id, 'int'), Cast(score, 'int'), Cast(count, 'int')) for user_id, (score, count) in deltas.items()],
+                        columns=('id', 'score', 'count'), alias='credit')
+    return (User
+            .update(total_score=User.total_score + credit.c.score, achievement_count=User.achievement_count + credit.c.count)
+            .from_(credit)
+            .where(User.id == credit.c.id))
 
+def credit_users(deltas: dict[int, tuple[int, int]]) -> None:
+    if not deltas:
+        return
+    credit_users_query(deltas).execute()
+    bump_revisions(*[user_revision(user_id) for user_id in deltas])
+
+def record_activities_query(activity: dict[tuple[int, datetime.date], tuple[int, int]]):
+    """Upsert adding (grants, score) to the activity of each (user_id, day), see `record_activity_query`"""
+    return (UserActivity
+            .insert_many([(user_id, day, grants, score) for (user_id, day), (grants, score) in activity.items()],
+                         fields=[UserActivity.user, UserActivity.day, UserActivity.grants, UserActivity.score])
+            .on_conflict(conflict_target=[UserActivity.user, UserActivity.day],
+                         update={UserActivity.grants: UserActivity.grants + EXCLUDED.grants,
+                                 UserActivity.score: UserActivity.score + EXCLUDED.score})
+            .returning())
+
+def grant_lookup_queries(chunk: list[tuple[int, int, datetime.datetime]], skip_duplicates: bool) -> tuple:
+    """Queries for the known users, the achievement scores and (when skipping duplicates) the existing grants of a chunk"""
+    user_ids = list({user_id for user_id, _, _ in chunk})
+    achievement_ids = list({achievement_id for _, achievement_id, _ in chunk})
+    users = User.select(User.id).where(User.id.in_(user_ids))
+    scores = Achievement.select(Achievement.id, Achievement.score).where(Achievement.id.in_(achievement_ids))
+    existing = None
+    if skip_duplicates:
+        pairs = [(user_id, achievement_id) for user_id, achievement_id, _ in chunk]
+        existing = (UserAchievement
+                    .select(UserAchievement.user_id, UserAchievement.achievement_id)
+                    .where(Tuple(UserAchievement.user_id, UserAchievement.achievement_id).in_(pairs)))
+    return users, scores, existing
+
+class GrantPlan:
+    """Statuses, rows, per-user deltas and per-(user, day) activity of a batch of grants, validated chunk by chunk"""
+    def __init__(self, skip_duplicates: bool):
+        self.skip_duplicates = skip_duplicates
+        self.now = datetime.datetime.now()
+        self.statuses = []
+        self.seen = set()
+        self.deltas = {}
+        self.activity = {}
+
+    def rows(self, chunk, known_users: set, scores: dict, existing: set) -> list[tuple[int, int, datetime.datetime]]:
+        """Rows to insert for `chunk`, given the results of its `grant_lookup_queries`"""
+        rows = []
+        for user_id, achievement_id, date in chunk:
+            if user_id not in known_users:
+                self.statuses.append(GrantStatus.UNKNOWN_USER)
+            elif achievement_id not in scores:
+                self.statuses.append(GrantStatus.UNKNOWN_ACHIEVEMENT)
+            elif self.skip_duplicates and ((user_id, achievement_id) in existing or (user_id, achievement_id) in self.seen):
+                self.statuses.append(GrantStatus.DUPLICATE)
+            else:
+                self.seen.add((user_id, achievement_id))
+                rows.append((user_id, achievement_id, date or self.now))
+                score, count = self.deltas.get(user_id, (0, 0))
+                self.deltas[user_id] = (score + scores[achievement_id], count + 1)
+                day = (user_id, (date or self.now).date())
+                grants, score = self.activity.get(day, (0, 0))
+                self.activity[day] = (grants + 1, score + scores[achievement_id])
+                self.statuses.append(GrantStatus.GRANTED)
+        return rows
+
+def insert_grants_query(rows: list[tuple[int, int, datetime.datetime]]):
+    return UserAchievement.insert_many(rows, fields=[UserAchievement.user, UserAchievement.achievement, UserAchievement.date])
+
+@changes_statistics
 @db_transaction
+def grant_user_achievements(grants: list[tuple[int, int, datetime.datetime]], skip_duplicates: bool = False) -> list[GrantStatus]:
+    """Grant (user_id, achievement_id, date) triples with chunked multi-row inserts, returning a status per grant"""
+    plan = GrantPlan(skip_duplicates)
+    for chunk in chunked(grants, GRANT_BATCH_SIZE):
+        users, scores, existing = grant_lookup_queries(chunk, skip_duplicates)
+        rows = plan.rows(chunk, {user_id for user_id, in users.tuples()}, dict(scores.tuples()),
+                         set(existing.tuples()) if existing is not None else set())
+        if rows:
+            insert_grants_query(rows).execute()
+            publish_changes(rows)
+    credit_users(plan.deltas)
+    if plan.deltas:
+        recount_streaks(list(plan.deltas))
+        for activity in chunked(plan.activity.items(), GRANT_BATCH_SIZE):
+            record_activities_query(dict(activity)).execute()
+        publish_changes(user_ids=list(plan.deltas))
+    return plan.statuses
+
+@db_read(lambda user_id, *args, **kwargs: [user_revision(user_id)])
 def get_user_achievements(user_id: int) -> list:
     user_achievements = [ua.achievement_id for ua in UserAchievement.select().where(UserAchievement.user_id == user_id)]
     return user_achievements
 
-@db_transaction
+@db_read(lambda *args, **kwargs: [CATALOG_REVISION])
 def get_achievements_translations(achievement_ids: list[int], language: Language) -> list:
-    translations = []
-    for achievement_id in achievement_ids:
-        translation = get_translation(achievement_id, language)
-        translations.append(translation)
-    return translations
+    translations = dict((achievement.id, translation) for achievement, translation in load_achievements(language, achievement_ids))
+    return [translations.get(achievement_id) for achievement_id in achievement_ids]
 
-@db_transaction
+def max_achievements_query():
+    return User.select().order_by(User.achievement_count.desc(), User.id.desc()).limit(1)
+
+def max_score_query():
+    return User.select().order_by(User.total_score.desc(), User.id.desc()).limit(1)
+
+@db_read()
 def get_user_with_max_achievements() -> tuple[User, int]:
-    user = (User
-            .select(User, fn.Count(UserAchievement.id).alias('achievement_count'))
-            .join(UserAchievement)
-            .group_by(User.id)
-            .order_by(fn.Count(UserAchievement.id).desc())
-            .get())
+    user = max_achievements_query().get()
     return user, user.achievement_count
 
-@db_transaction
+@db_read()
 def get_user_with_max_score() -> User:
-    user = User.select().order_by(User.total_score.desc()).get()
+    user = max_score_query().get()
     return user
 
+def min_score_diff_query(limit: int = None):
+    """(lower_id, higher_id, difference) of users adjacent by score, closest first.
+
+    The `limit` closest pairs, or every pair tied for the minimum difference when `limit` is not given.
+    """
+    order = [User.total_score, User.id]
+    gaps = (User
+            .select(fn.LAG(User.id).over(order_by=order).alias('previous_id'),
+                    User.id.alias('user_id'),
+                    (User.total_score - fn.LAG(User.total_score).over(order_by=order)).alias('difference'))
+            .alias('gaps'))
+    pairs = (Select([gaps], [gaps.c.previous_id, gaps.c.user_id, gaps.c.difference,
+                             fn.RANK().over(order_by=[gaps.c.difference]).alias('tie')])
+             .where(gaps.c.previous_id.is_null(False))
+             .order_by(gaps.c.difference, gaps.c.user_id))
+    if limit:
+        pairs = pairs.limit(limit)
+    else:
+        pairs = pairs.alias('pairs')
+        pairs = (Select([pairs], [pairs.c.previous_id, pairs.c.user_id, pairs.c.difference])
+                 .where(pairs.c.tie == 1)
+                 .order_by(pairs.c.difference, pairs.c.user_id))
+    return pairs.bind(database)
+
+def users_query(user_ids):
+    return User.select().where(User.id.in_(list(user_ids)))
+
+def pair_users(pairs: list[tuple], users: list[User]) -> list[tuple[User, User, int]]:
+    users = {user.id: user for user in users}
+    return [(users[previous_id], users[user_id], difference) for previous_id, user_id, difference, *_ in pairs]
+
+@db_read()
+def get_users_with_min_score_diff(limit: int = None) -> list[tuple[User, User, int]]:
+    """Pairs of users adjacent by score as (lower, higher, difference), see `min_score_diff_query`"""
+    pairs = list(min_score_diff_query(limit).tuples())
+    return pair_users(pairs, users_query([user_id for pair in pairs for user_id in pair[:2]]))
+
+def max_score_diff_query():
+    """Highest and lowest scoring users, each read from the (total_score, id) index in one round-trip"""
+    max_score_user = User.select().order_by(User.total_score.desc(), User.id.desc()).limit(1)
+    min_score_user = User.select().order_by(User.total_score, User.id).limit(1)
+    return max_score_user + min_score_user
+
+@db_read()
+def get_users_with_max_score_diff() -> list[User]:
+    return list(max_score_diff_query())
+
+@db_read(lambda user_ids: [CATALOG_REVISION, *map(user_revision, user_ids)])
+def get_users_profiles(user_ids: list[int]) -> dict[int, tuple[User, list[tuple[Achievement, list]]]]:
+    """Users with their granted achievements localized to each user's language.
+
+    Two queries (users, grants) when the achievements are cached, plus one for the achievements that are not.
+    """
+    users = list(users_query(user_ids))
+    if not users:
+        return {}
+    grants = list(grants_query([user.id for user in users]).tuples())
+    return build_profiles(users, grants, cached_achievements([achievement_id for _, achievement_id in grants]))
+
+def grants_query(user_ids: list[int]):
+    return (UserAchievement
+            .select(UserAchievement.user_id, UserAchievement.achievement_id)
+            .where(UserAchievement.user_id.in_(user_ids))
+            .order_by(UserAchievement.id))
+
+def build_profiles(users: list[User], grants: list[tuple[int, int]], entries: dict) -> dict:
+    """Profiles of `get_users_profiles` from its users, their (user_id, achievement_id) grants and the cached achievements"""
+    profiles = {user.id: (user, []) for user in users}
+    for user_id, achievement_id in grants:
+        user, achievements = profiles[user_id]
+        achievements.append(localize(entries, achievement_id, user.language))
+    return profiles
+
+@db_read(lambda users: [CATALOG_REVISION, *map(user_revision, users)])
+def get_users_achievements(users: list[int]) -> dict:
+    return {user_id: ([achievement.id for achievement, _ in achievements], user.total_score)
+            for user_id, (user, achievements) in get_users_profiles(users).items()}
+
+def streak_query(day_streak: int = 7, limit: int = 100):
+    """Users with at least `day_streak` consecutive active days, ending today"""
+    users = (User
+             .select()
+             .join(UserStreak)
+             .where((UserStreak.last_active_day == datetime.date.today()) & (UserStreak.current_streak >= day_streak))
+             .order_by(UserStreak.current_streak.desc(), User.id))
+    if limit > 0:
+        users = users.limit(limit)
+    return users
+
+@db_read()
+def get_users_with_streak(day_streak: int = 7, limit: int = 100) -> list:
+    return list(streak_query(day_streak, limit))
+
+@changes_statistics
 @db_transaction
-def get_users_with_min_score_diff() -> list:
-    users = User.select().order_by(User.total_score)
-    closest_pair = None
-    min_difference = float('inf')
+def rebuild_streaks() -> int:
+    recount_streaks()
+    return UserStreak.select().count()
+
+def window_start(days: int) -> datetime.date:
+    """First day of a window of `days` days ending today"""
+    return datetime.date.today() - datetime.timedelta(days=days - 1)
 
-    for i in range(len(users) - 1):
-        user1 = users[i]
-        user2 = users[i + 1]
-        score_difference = abs(user1.total_score - user2.total_score)
+def top_scorers_query(days: int, limit: int = 10):
+    """(user_id, score, grants) of the users who scored the most over the last `days` days, from their daily activity"""
+    score = fn.SUM(UserActivity.score)
+    return (UserActivity
+            .select(UserActivity.user_id, score, fn.SUM(UserActivity.grants))
+            .where(UserActivity.day >= window_start(days))
+            .group_by(UserActivity.user_id)
+            .order_by(score.desc(), UserActivity.user_id)
+            .limit(limit))
 
-        if score_difference < min_difference:
-            min_difference = score_difference
-            closest_pair = (user1, user2)
+def user_activity_query(user_id: int, days: int):
+    """(day, grants, score) of the user's active days among the last `days` days"""
+    return (UserActivity
+            .select(UserActivity.day, UserActivity.grants, UserActivity.score)
+            .where((UserActivity.user_id == user_id) & (UserActivity.day >= window_start(days)))
+            .order_by(UserActivity.day))
 
-        if min_difference == 0:
-            break
+def scorer_users(scorers: list[tuple], users: list[User]) -> list[tuple[User, int, int]]:
+    users = {user.id: user for user in users}
+    return [(users[user_id], score, grants) for user_id, score, grants in scorers]
 
-    return closest_pair
+@db_read()
+def get_top_scorers(days: int, limit: int = 10) -> list[tuple[User, int, int]]:
+    """(user, score, grants) of the top scorers over the last `days` days, see `top_scorers_query`"""
+    scorers = list(top_scorers_query(days, limit).tuples())
+    return scorer_users(scorers, users_query([user_id for user_id, _, _ in scorers]))
 
+@db_read(lambda user_id, *args, **kwargs: [user_revision(user_id)])
+def get_user_activity(user_id: int, days: int) -> list[tuple[datetime.date, int, int]]:
+    User.get_by_id(user_id)
+    return list(user_activity_query(user_id, days).tuples())
+
+@changes_statistics
 @db_transaction
-def get_users_with_max_score_diff() -> tuple[User]:
-    max_score_user = (User
-                      .select()
-                      .order_by(User.total_score.desc())
-                      .limit(1)
-                      .get())
-    min_score_user = (User
-                      .select()
-                      .order_by(User.total_score.asc())
-                      .limit(1)
-                      .get())
-    return max_score_user, min_score_user
+def rebuild_activity() -> int:
+    recount_activity()
+    return UserActivity.select().count()
 
+@changes_statistics
 @db_transaction
-def get_users_achievements(users: list[int]) -> list:
-    users_achievements = {}
-    for user_id in users:
-        user_achievements = get_user_achievements(user_id)
-        total_score = User.get_by_id(user_id).total_score
-        users_achievements[user_id] = (user_achievements, total_score)
-    return users_achievements
+def reconcile_scores(dry_run: bool = False) -> list[tuple[int, int, int, int, int]]:
+    """Recompute every total_score and achievement_count in one set-based query.
+
+    Returns (user_id, stored_score, actual_score, stored_count, actual_count) for each drifted user.
+    """
+    if dry_run:
+        return list(score_drift_query().tuples())
+    drifted = list(reconcile_scores_query().tuples())
+    bump_revisions(*[user_revision(user_id) for user_id, *_ in drifted])
+    publish_changes(user_ids=[user_id for user_id, *_ in drifted])
+    return drifted
+
+def decode_leaderboard_cursor(cursor: str) -> tuple[int, int]:
+    total_score, user_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+    return int(total_score), int(user_id)
+
+def encode_leaderboard_cursor(user: User) -> str:
+    return base64.urlsafe_b64encode(f'{user.total_score}:{user.id}'.encode()).decode()
+
+def decode_achievement_cursor(cursor: str) -> int:
+    return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+
+def encode_achievement_cursor(achievement_id: int) -> str:
+    return base64.urlsafe_b64encode(str(achievement_id).encode()).decode()
+
+def decode_grant_cursor(cursor: str) -> tuple[datetime.datetime, int]:
+    grant_id, date = base64.urlsafe_b64decode(cursor.encode()).decode().split(':', 1)
+    return datetime.datetime.fromisoformat(date), int(grant_id)
+
+def encode_grant_cursor(grant_id: int, date: datetime.datetime) -> str:
+    return base64.urlsafe_b64encode(f'{grant_id}:{date.isoformat()}'.encode()).decode()
+
+def catalog_page_ids(after_id: int, limit: int) -> list[int]:
+    """Ids of a catalog page, plus the first id of the next one, from the cached catalog (None when not cached)"""
+    achievement_ids = achievement_cache.get(CATALOG_KEY)
+    if achievement_ids is None:
+        return None
+    start = bisect.bisect_right(achievement_ids, after_id)
+    return achievement_ids[start:start + limit + 1]
+
+def achievements_page_query(after_id: int, limit: int):
+    """A catalog page, plus one achievement, as a primary key range scan"""
+    page = Achievement.select(Achievement.id).where(Achievement.id > after_id).order_by(Achievement.id).limit(limit + 1)
+    return achievements_query(Lang.ALL).where(Achievement.id.in_(page))
+
+def achievements_page(entries: dict, page_ids: list[int], limit: int, language: Language) -> tuple[list[tuple[Achievement, list]], str]:
+    """(achievement, translation) pairs of a page and the cursor of the next page"""
+    page_ids = sorted(page_ids)
+    page = [localize(entries, achievement_id, language) for achievement_id in page_ids[:limit]]
+    return page, encode_achievement_cursor(page_ids[limit - 1]) if len(page_ids) > limit else None
+
+@db_read(lambda *args, **kwargs: [CATALOG_REVISION])
+def get_achievements_page(language: Language, limit: int, after: str = None) -> tuple[list[tuple[Achievement, list]], str]:
+    """A page of the catalog ordered by id, continuing after an opaque cursor, and the cursor of the next page.
+
+    Served from the cache when the catalog is cached, otherwise by one indexed query.
+    """
+    after_id = decode_achievement_cursor(after) if after else 0
+    page_ids = catalog_page_ids(after_id, limit)
+    if page_ids is None:
+        entries = cache_achievements(achievements_page_query(after_id, limit), achievement_cache.generation)
+    else:
+        entries = cached_achievements(page_ids)
+    return achievements_page(entries, list({achievement_id for achievement_id, _ in entries}), limit, language)
+
+def user_grants_query(user_id: int, limit: int, after: str = None, descending: bool = False):
+    """A page of the user's (grant id, achievement id, date), plus one row, over the (user, date, id) index"""
+    order = Tuple(UserAchievement.date, UserAchievement.id)
+    grants = (UserAchievement
+              .select(UserAchievement.id, UserAchievement.achievement_id, UserAchievement.date)
+              .where(UserAchievement.user_id == user_id))
+    if after:
+        date, grant_id = decode_grant_cursor(after)
+        grants = grants.where(order < Tuple(date, grant_id) if descending else order > Tuple(date, grant_id))
+    if descending:
+        return grants.order_by(UserAchievement.date.desc(), UserAchievement.id.desc()).limit(limit + 1)
+    return grants.order_by(UserAchievement.date, UserAchievement.id).limit(limit + 1)
+
+def grants_page(user: User, grants: list[tuple], entries: dict, limit: int) -> tuple[list[tuple], str]:
+    """(achievement, translation, language, date) of a page of grants localized to the user's language, and the next cursor"""
+    language = Lang(user.language)
+    page = [(*localize(entries, achievement_id, language), language, date) for _, achievement_id, date in grants[:limit]]
+    return page, encode_grant_cursor(*grants[limit - 1][::2]) if len(grants) > limit else None
 
+@db_read(lambda user_id, *args, **kwargs: [CATALOG_REVISION, user_revision(user_id)])
+def get_user_achievements_page(user_id: int, limit: int, after: str = None, descending: bool = False) -> tuple[list[tuple], str]:
+    """A page of the user's granted achievements ordered by grant date, and the cursor of the next page"""
+    query = user_grants_query(user_id, limit, after, descending)
+    user = User.get_by_id(user_id)
+    grants = list(query.tuples())
+    return grants_page(user, grants, cached_achievements([achievement_id for _, achievement_id, _ in grants[:limit]]), limit)
+
+def leaderboard_query(limit: int = 20, after: str = None):
+    """One user more than a page ordered by score, continuing after an opaque cursor"""
+    users = User.select().order_by(User.total_score.desc(), User.id.desc()).limit(limit + 1)
+    if after:
+        users = users.where(Tuple(User.total_score, User.id) < Tuple(*decode_leaderboard_cursor(after)))
+    return users
+
+def rank_counts_query(first: User):
+    """Number of users scored above `first`, and of those tied with it but ordered before it.
+
+    Two range scans of the (total_score, id) index, from `first` upwards: short ones on the first pages.
+    """
+    higher = User.select(fn.COUNT(User.id)).where(User.total_score > first.total_score)
+    tied_before = User.select(fn.COUNT(User.id)).where((User.total_score == first.total_score) & (User.id > first.id))
+    return Select(columns=[higher, tied_before]).bind(database)
+
+def rank_page(page: list[User], higher: int, tied_before: int) -> list[tuple[int, User]]:
+    """Competition ranking of a leaderboard page: 1 + number of users with a higher score"""
+    before = higher + tied_before
+    ranked = []
+    for position, user in enumerate(page):
+        if user.total_score == page[0].total_score:
+            rank = higher + 1
+        elif user.total_score != page[position - 1].total_score:
+            rank = before + position + 1
+        ranked.append((rank, user))
+    return ranked
+
+@db_read()
+def get_leaderboard(limit: int = 20, after: str = None) -> tuple[list[tuple[int, User]], str]:
+    """A page of (rank, user) ordered by score, continuing after an opaque cursor, and the cursor of the next page"""
+    users = list(leaderboard_query(limit, after))
+    page, users = users[:limit], users[limit:]
+    if not page:
+        return [], None
+    higher, tied_before = rank_counts_query(page[0]).tuples().get()
+    return rank_page(page, higher, tied_before), encode_leaderboard_cursor(page[-1]) if users else None
+
+def user_rank_query(user: User):
+    """Users scored above `user`, users tied with it, and the planner's estimate of the number of users.
+
+    The counts are range scans of the (total_score, id) index, so a user near the top is cheap to rank; the total
+    comes from pg_class.reltuples (as of the last ANALYZE) rather than a count of the whole table, and is only
+    counted for a table that was never analyzed.
+    """
+    table = User._meta.table_name
+    higher = User.select(fn.COUNT(User.id)).where(User.total_score > user.total_score)
+    tied = User.select(fn.COUNT(User.id)).where(User.total_score == user.total_score)
+    total = SQL(f"""(SELECT CASE WHEN reltuples >= 0 THEN reltuples::bigint ELSE (SELECT COUNT(*) FROM "{table}") END
+                     FROM pg_class WHERE oid = '"{table}"'::regclass)""")
+    return Select(columns=[higher, tied, total]).bind(database)
+
+def rank_totals(higher: int, tied: int, total: int) -> tuple[int, int, int]:
+    """(higher, lower, total) from the counts of `user_rank_query`, the estimated total raised to the counted users"""
+    total = max(total, higher + tied)
+    return higher, total - higher - tied, total
+
+@db_read(lambda user_id, *args, **kwargs: [user_revision(user_id)])
+def get_user_rank(user_id: int) -> tuple[User, int, int, int]:
+    """User's competition rank, the number of users scored strictly below and the (estimated) number of users"""
+    user = User.get_by_id(user_id)
+    higher, lower, total = rank_totals(*user_rank_query(user).tuples().get())
+    return user, higher + 1, lower, total
+
+_cursor_names = itertools.count(1)
+
+def stream_rows(query, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[tuple]:
+    """Rows of `query` fetched `batch_size` at a time through a server-side cursor, inside the current transaction"""
+    sql, params = query.sql()
+    # peewee runs psycopg2 in autocommit mode and begins transactions itself, hence WITH HOLD; the cursor is closed
+    # before the transaction ends, so its rows are never materialized
+    cursor = database.connection().cursor(name=f'export_{next(_cursor_names)}', withhold=True)
+    cursor.itersize = batch_size
+    try:
+        cursor.execute(sql, params)
+        yield from cursor
+    finally:
+        cursor.close()
+
+def export_records() -> Iterator[dict]:
+    """Every user, achievement (with its translations) and grant as NDJSON records, from one consistent snapshot.
+
+    A generator holding its own connection, so it can outlive the request that started it.
+    """
+    opened = database.is_closed()
+    if opened:
+        database.connect()
+    try:
+        with database.atomic():
+            database.execute_sql('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+            users = User.select(User.id, User.username, User.language).order_by(User.id)
+            for user_id, username, language in stream_rows(users):
+                yield {'type': 'user', 'id': user_id, 'username': username, 'language': language.strip()}
+
+            achievements = (Achievement
+                            .select(Achievement.id, Achievement.score, AchievementTranslation.language,
+                                    AchievementTranslation.title, AchievementTranslation.description)
+                            .join(AchievementTranslation, JOIN.LEFT_OUTER)
+                            .order_by(Achievement.id, AchievementTranslation.language))
+            for (achievement_id, score), rows in itertools.groupby(stream_rows(achievements), key=lambda row: row[:2]):
+                translations = {language: {'title': title, 'description': description}
+                                for _, _, language, title, description in rows if language is not None}
+                yield {'type': 'achievement', 'id': achievement_id, 'score': score, 'translations': translations}
+
+            grants = (UserAchievement
+                      .select(UserAchievement.user_id, UserAchievement.achievement_id, UserAchievement.date)
+                      .order_by(UserAchievement.id))
+            for user_id, achievement_id, date in stream_rows(grants):
+                yield {'type': 'grant', 'user_id': user_id, 'achievement_id': achievement_id, 'datetime': date.isoformat()}
+    finally:
+        if opened and not database.is_closed():
+            database.close()
+
+class RecordImport:
+    """Buffers imported records into multi-row inserts; users and achievements are flushed before the grants that need them"""
+    def __init__(self, batch_size: int = IMPORT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.users = []
+        self.achievements = []
+        self.translations = []
+        self.grants = []
+        self.counts = {'users': 0, 'achievements': 0, 'grants': 0}
+
+    def add(self, record: dict) -> None:
+        kind = record.get('type')
+        if kind == 'user':
+            language = Lang(record['language'])
+            if language not in LANGUAGES:
+                raise ValueError(f'Unsupported user language {language.value!r}')
+            self.users.append((record['id'], record['username'], language.value, 0, 0))
+        elif kind == 'achievement':
+            self.achievements.append((record['id'], record['score']))
+            for language, translation in record.get('translations', {}).items():
+                self.translations.append((record['id'], translation_language(language).value, translation['title'],
+                                          translation['description']))
+        elif kind == 'grant':
+            date = datetime.datetime.fromisoformat(record['datetime']) if record.get('datetime') else datetime.datetime.now()
+            self.grants.append((record['user_id'], record['achievement_id'], date))
+        else:
+            raise ValueError(f'Unknown record type {kind!r}')
+        if len(self.users) >= self.batch_size or len(self.achievements) >= self.batch_size:
+            self.flush_catalog()
+        if len(self.grants) >= self.batch_size:
+            self.flush()
+
+    def flush_catalog(self) -> None:
+        if self.users:
+            User.insert_many(self.users, fields=[User.id, User.username, User.language, User.total_score,
+                                                 User.achievement_count]).execute()
+            self.counts['users'] += len(self.users)
+            self.users = []
+        if self.achievements:
+            Achievement.insert_many(self.achievements, fields=[Achievement.id, Achievement.score]).execute()
+            self.counts['achievements'] += len(self.achievements)
+            self.achievements = []
+        if self.translations:
+            AchievementTranslation.insert_many(self.translations, fields=[AchievementTranslation.achievement, AchievementTranslation.language,
+                                                                          AchievementTranslation.title, AchievementTranslation.description]).execute()
+            self.translations = []
+
+    def flush(self) -> None:
+        self.flush_catalog()
+        if self.grants:
+            insert_grants_query(self.grants).execute()
+            self.counts['grants'] += len(self.grants)
+            self.grants = []
+
+def reset_sequences() -> None:
+    """Move id sequences past the ids inserted explicitly"""
+    for model in (User, Achievement, UserAchievement):
+        table = model._meta.table_name
+        database.execute_sql(f'''SELECT setval(pg_get_serial_sequence('"{table}"', 'id'), COALESCE(MAX(id), 1), MAX(id) IS NOT NULL)
+                                 FROM "{table}"''')
+
+@changes_statistics
 @db_transaction
-def get_users_with_streak(day_streak: int = 7, limit: int = 100) -> list:
-    streak_users = []
-    users = User.select().limit(limit) if limit > 0 else User.select()
-    for user in users:
-        streak = 0
-        day_difference = datetime.timedelta(days=0)
-        now = datetime.datetime.now()
-        for ua in UserAchievement.select().where(UserAchievement.user_id == user.id).order_by(UserAchievement.date.desc()):
-            print(ua.date.date())
-            if ua.date.date() == (now - day_difference).date():
-                streak += 1
-                day_difference += datetime.timedelta(days=1)
-            else:
-                break
-        if streak >= day_streak:
-            streak_users.append(user)
-    return streak_users
\ No newline at end of file
+def import_records(records: Iterable[dict]) -> dict[str, int]:
+    """Insert exported records keeping their ids, in bounded-memory chunks and a single transaction.
+
+    Scores, achievement counts, streaks and daily activity are recomputed once at the end. Returns the number of records imported per kind.
+    """
+    try:
+        importer = RecordImport()
+        for number, record in enumerate(records, 1):
+            try:
+                importer.add(record)
+            except (KeyError, TypeError, ValueError) as error:
+                raise ValueError(f'Record {number}: {error!r}') from error
+        importer.flush()
+        reset_sequences()
+        # Set-based, without the per-user report, revisions and score events of reconcile_scores: every imported user
+        # is new, so no client or replica holds an older version of it
+        reconcile_scores_query(report=False).execute()
+        recount_streaks()
+        recount_activity()
+        if importer.counts['achievements']:
+            bump_revisions(CATALOG_REVISION)
+        return importer.counts
+    finally:
+        achievement_cache.clear()
+
+def export_ndjson() -> Iterator[str]:
+    """`export_records` as NDJSON text, in chunks of EXPORT_BATCH_SIZE lines"""
+    for records in chunked(export_records(), EXPORT_BATCH_SIZE):
+        yield ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+
+def read_records(lines: Iterable) -> Iterator[dict]:
+    """Records of NDJSON lines (str or bytes), skipping blank lines"""
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as error:
+                raise ValueError(f'Line {number}: {error}') from error
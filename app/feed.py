@@ -0,0 +1,97 @@
+"""Change events published by writes with `publish_changes_sql`, fanned out to the subscribers of this process.
+
+A single connection per process LISTENs on the channel. Each subscriber gets a bounded queue: one that falls
+`queue_size` events behind is dropped rather than buffered, and has to resynchronize from the read endpoints.
+"""
+import asyncio
+import json
+import logging
+from contextlib import suppress
+from os import getenv
+
+import asyncpg
+
+from app.db import CHANGES_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+class Subscription:
+    """Events of one user's grants and scores, and/or of every score change (the leaderboard)"""
+    def __init__(self, user_id: int = None, leaderboard: bool = False, queue_size: int = 100):
+        self.user_id = user_id
+        self.leaderboard = leaderboard
+        self.queue = asyncio.Queue(queue_size)
+        # Why the feed stopped delivering: 'overflow' (fell behind) or 'reset' (the LISTEN connection was lost)
+        self.closed = None
+
+    def wants(self, event: dict) -> bool:
+        return event.get('user_id') == self.user_id or (self.leaderboard and event['type'] == 'score')
+
+    def put(self, event: dict) -> bool:
+        """Queue `event`, or close the subscription when its queue is full"""
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.close('overflow')
+            return False
+        return True
+
+    def close(self, reason: str) -> None:
+        self.closed = reason
+        # Wakes up a reader waiting on an empty queue; a full queue is drained first anyway
+        with suppress(asyncio.QueueFull):
+            self.queue.put_nowait(None)
+
+    async def get(self) -> dict:
+        """Next event, or None once the subscription is closed and its queued events were read"""
+        if self.closed and self.queue.empty():
+            return None
+        return await self.queue.get()
+
+class ChangeFeed:
+    """The LISTEN connection of this process, dispatching each event to the subscriptions that want it"""
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.subscriptions = set()
+        self.connection: asyncpg.Connection = None
+        self._connecting = asyncio.Lock()
+
+    async def listen(self) -> None:
+        """Open the LISTEN connection, unless it is open already"""
+        async with self._connecting:
+            if self.connection is not None and not self.connection.is_closed():
+                return
+            connection = await asyncpg.connect(getenv('DB_URL'))
+            connection.add_termination_listener(self._terminated)
+            await connection.add_listener(CHANGES_CHANNEL, self._dispatch)
+            self.connection = connection
+
+    async def subscribe(self, user_id: int = None, leaderboard: bool = False) -> Subscription:
+        await self.listen()
+        subscription = Subscription(user_id, leaderboard, self.queue_size)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.subscriptions.discard(subscription)
+
+    def _dispatch(self, connection, pid, channel, payload) -> None:
+        event = json.loads(payload)
+        for subscription in list(self.subscriptions):
+            if subscription.wants(event) and not subscription.put(event):
+                logger.warning('Dropped a change feed subscriber %d events behind', self.queue_size)
+                self.subscriptions.discard(subscription)
+
+    def _terminated(self, connection) -> None:
+        # Events may have been missed: end every subscription, so that its client resubscribes and resynchronizes
+        if connection is self.connection:
+            self.connection = None
+        for subscription in self.subscriptions:
+            subscription.close('reset')
+        self.subscriptions.clear()
+
+    async def close(self) -> None:
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            await connection.close()
+        self._terminated(connection)
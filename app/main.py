@@ -1,20 +1,137 @@
-from typing import Optional
-from contextlib import asynccontextmanager
-
-from fastapi import FastAPI
-from pydantic import BaseModel
-
+from typing import Optional, Callable, Hashable, Literal
+from contextlib import asynccontextmanager, suppress
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import APIRouter, FastAPI, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from peewee import IntegrityError
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from pydantic import BaseModel, Field
+
+import asyncio
 import datetime
+import functools
+import hashlib
+import json
+import tempfile
+import time
+from os import getenv
 
 import app.db_functions as db
+import app.db_async as db_async
+import app.metrics as metrics
+import app.migrations as migrations
+from app.db import track_queries
+from app.feed import ChangeFeed, Subscription
+from app.snapshot import Snapshot
+
+class ThreadpoolBackend:
+    """The sync `db_functions`, awaited through the threadpool so they can stand in for `db_async`"""
+    def __getattr__(self, name):
+        func = getattr(db, name)
+        @functools.wraps(func)
+        async def call(*args, **kwargs):
+            return await run_in_threadpool(func, *args, **kwargs)
+        return call
+
+# 'sync' (peewee/psycopg2 in the threadpool) or 'async' (asyncpg on the event loop)
+DB_BACKEND = getenv('DB_BACKEND', 'sync')
+store = db_async if DB_BACKEND == 'async' else ThreadpoolBackend()
+# Page sizes of the keyset-paginated listings: default, maximum, and per round-trip when streaming NDJSON
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_PAGE_SIZE = 1000
+# Longest window of the windowed statistics, in days
+MAX_WINDOW_DAYS = 366
+# Imported NDJSON bodies larger than this are spooled to a temporary file
+IMPORT_SPOOL_SIZE = 8 * 1024 * 1024
+# Report each request's SQL statement count and database time in X-DB-Queries / X-DB-Time (ms) headers
+QUERY_HEADERS = getenv('DB_QUERY_HEADERS', 'false').lower() in ('1', 'true', 'yes')
+
+# Responses of the /statistics endpoints, served for up to STATISTICS_MAX_AGE seconds after a change while the
+# lifespan refresher recomputes them, at most STATISTICS_REFRESH_INTERVAL seconds after the change. Responses not
+# requested for STATISTICS_MAX_IDLE seconds are no longer refreshed
+statistics = Snapshot(lambda: db.statistics_version,
+                      max_age=float(getenv('STATISTICS_MAX_AGE', 10)),
+                      refresh_interval=float(getenv('STATISTICS_REFRESH_INTERVAL', 1)),
+                      max_idle=float(getenv('STATISTICS_MAX_IDLE', 300)))
+
+# Grant and score change events: per-subscriber queue size, and seconds between keepalive comments of an idle stream
+changes = ChangeFeed(queue_size=int(getenv('CHANGES_QUEUE_SIZE', 100)))
+CHANGES_KEEPALIVE = float(getenv('CHANGES_KEEPALIVE', 15))
+
+# Seconds between health checks of the DB_REPLICA_URLS replicas
+REPLICA_CHECK_INTERVAL = float(getenv('DB_REPLICA_CHECK_INTERVAL', 5))
+
+async def check_replicas():
+    while True:
+        await asyncio.to_thread(db.replicas.check)
+        await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+
+async def refresh_statistics():
+    # Not a request: start with a connection state of its own
+    db.database._state.new_context()
+    await statistics.run()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Start db
-    db.create_db()
+    # Migrations are applied by `python -m app.cli migrate` before the workers start
+    migrations.check_schema()
+    if store is db_async:
+        await db_async.connect()
+    else:
+        db.database.fill()
+    tasks = [asyncio.create_task(refresh_statistics())]
+    if db.replicas.databases:
+        tasks.append(asyncio.create_task(check_replicas()))
     yield
+    for task in tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    await changes.close()
+    if store is db_async:
+        await db_async.close()
+    db.database.close_all()
+    for replica in db.replicas.databases:
+        replica.close_all()
+
+async def reset_db_state():
+    db.database._state.new_context()
+
+def get_db(db_state=Depends(reset_db_state)):
+    # One pooled connection per request, shared by every db helper it calls (the async backend acquires its own)
+    if store is db_async:
+        yield
+        return
+    db.database.connect()
+    try:
+        with db.pinned_reads():
+            yield
+    finally:
+        if not db.database.is_closed():
+            db.database.close()
 
 app = FastAPI(lifespan=lifespan)
+# Routes that use the database; /, /metrics and /events do not, so they are served even while the pool is exhausted
+api = APIRouter(dependencies=[Depends(get_db)])
+# /statistics routes, served from the snapshot without a pooled connection: a recompute checks one out per query
+statistics_api = APIRouter(dependencies=[Depends(reset_db_state)])
+
+@app.middleware('http')
+async def instrument(request: Request, call_next):
+    queries = track_queries()
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get('route')
+    metrics.observe_request(request.method, route.path if route else 'unmatched', response.status_code,
+                            time.perf_counter() - start, queries)
+    if QUERY_HEADERS:
+        response.headers['X-DB-Queries'] = str(queries.count)
+        response.headers['X-DB-Time'] = f'{queries.seconds * 1000:.2f}'
+    return response
 
 class User(BaseModel):
     id: Optional[int]
@@ -29,10 +146,6 @@ class AchievementBase(BaseModel):
     id: Optional[int]
     score: int
 
-class UserStats(User):
-    total_score: int
-    achievements: Optional[list[AchievementBase]]
-
 class AchievementTranslation(BaseModel):
     language: db.Language
     title: Optional[str]
@@ -48,43 +161,135 @@ class Achievement(AchievementBase):
 class AchievementFull(AchievementBase):
     translations: list[AchievementTranslation]
 
+class UserStats(User):
+    total_score: int
+    achievements: Optional[list[Achievement | AchievementFull]]
+
 class UserAchievement(BaseModel):
     user_id: int
     achievement_id: int
     datetime: Optional[datetime.datetime]
     translation: Optional[AchievementTranslation]
 
+class GrantInput(BaseModel):
+    user_id: int
+    achievement_id: int
+    date: Optional[datetime.datetime] = Field(default=None, alias='datetime')
+
+class GrantBatchInput(BaseModel):
+    grants: list[GrantInput]
+    skip_duplicates: bool = False
+
+class GrantResult(BaseModel):
+    user_id: int
+    achievement_id: int
+    status: db.GrantStatus
+
+class ScorePair(BaseModel):
+    users: list[UserStats]
+    difference: int
+
+class LeaderboardEntry(BaseModel):
+    rank: int
+    id: int
+    username: str
+    total_score: int
+    achievement_count: int
+
+class Leaderboard(BaseModel):
+    items: list[LeaderboardEntry]
+    next_cursor: Optional[str]
+
+class UserRank(BaseModel):
+    id: int
+    total_score: int
+    rank: int
+    percentile: float
+
+class TopScorer(BaseModel):
+    id: int
+    username: str
+    score: int
+    grants: int
+
+class DailyActivity(BaseModel):
+    day: datetime.date
+    grants: int
+    score: int
+
+class GrantedAchievement(Achievement):
+    granted_at: datetime.datetime
+
+class GrantedAchievementFull(AchievementFull):
+    granted_at: datetime.datetime
+
 class UserFull(BaseModel):
     id: int
     username: str
     language: db.Language
     total_score: int
-    achievements: list[AchievementFull]
+    achievements: list[Achievement | AchievementFull]
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # Weak comparison, as If-None-Match requires
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return '*' in tags or etag.removeprefix('W/') in tags
+
+async def conditional_response(request: Request, revisions: list[str], build: Callable) -> Response:
+    """JSON response with ETag/Last-Modified derived from `revisions`; 304 without awaiting `build()` when the client is up to date"""
+    versions = await store.get_revisions(revisions)
+    fingerprint = repr((request.url.path, str(request.query_params), [versions.get(name) for name in revisions]))
+    etag = f'W/"{hashlib.sha1(fingerprint.encode()).hexdigest()[:20]}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    last_modified = max((updated_at for _, updated_at in versions.values()), default=None)
+    if last_modified:
+        last_modified = last_modified.replace(tzinfo=datetime.timezone.utc, microsecond=0)
+        headers['Last-Modified'] = format_datetime(last_modified, usegmt=True)
+
+    if_none_match = request.headers.get('if-none-match')
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_none_match is not None:
+        not_modified = etag_matches(if_none_match, etag)
+    elif if_modified_since and last_modified:
+        try:
+            not_modified = last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            not_modified = False
+    else:
+        not_modified = False
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(jsonable_encoder(await build()), headers=headers)
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"Hello": "World"}
 
+@app.get('/metrics', include_in_schema=False)
+async def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 
-@app.post("/user")
-def create_user(user: UserInput) -> dict:
-    user = db.create_user(user.username, user.language)
+@api.post("/user")
+async def create_user(user: UserInput) -> dict:
+    user = await store.create_user(user.username, user.language)
     return {'id': user}
 
-@app.post('/achievement')
-def create_achievement(achievement: AchievementCreateInput) -> AchievementBase:
+@api.post('/achievement')
+async def create_achievement(achievement: AchievementCreateInput) -> AchievementBase:
     score = achievement.score
     translations = achievement.translations
-    id = db.create_achievement(score=score)
+    id = await store.create_achievement(score=score)
     for tl in translations:
-        db.translate_achievement(id, tl.language, tl.title, tl.description)
+        await store.translate_achievement(id, tl.language, tl.title, tl.description)
     return AchievementBase(id=id, score=score)
 
 def achievement_db2type(db_achievement, db_translation, language: db.Language):
     if language and language is not db.Lang.ALL:
         if db_translation:
+            # The translation may be in a fallback language
             achievement = Achievement(id=db_achievement.id, score=db_achievement.score,
-                                        translation=AchievementTranslation(language=language, 
+                                        translation=AchievementTranslation(language=db.Lang(db_translation.language), 
                                                                            title=db_translation.title, 
                                                                            description=db_translation.description))
         else:
@@ -93,10 +298,8 @@ def achievement_db2type(db_achievement, db_translation, language: db.Language):
         return achievement
     else:
         tls = []
-        langs = [i for i in db.Lang][:-1]
-        for lang, tl in zip(langs, db_translation):
-            if tl:
-                tls.append(AchievementTranslation(language=lang, title=tl.title, description=tl.description))
+        for tl in db_translation:
+            tls.append(AchievementTranslation(language=db.Lang(tl.language), title=tl.title, description=tl.description))
         achievement = AchievementFull(id=db_achievement.id, score=db_achievement.score, translations=tls)
         return achievement
 
@@ -104,7 +307,7 @@ def achievement_db2user_type(db_achievement, db_translation, language: db.Langua
     if language and language is not db.Lang.ALL:
         if db_translation:
             achievement = UserAchievement(id=db_achievement.id, score=db_achievement.score, date_granted=db_achievement.date_granted,
-                                        translation=AchievementTranslation(language=language, 
+                                        translation=AchievementTranslation(language=db.Lang(db_translation.language), 
                                                                            title=db_translation.title, 
                                                                            description=db_translation.description))
         else:
@@ -114,74 +317,259 @@ def achievement_db2user_type(db_achievement, db_translation, language: db.Langua
     else:
         raise ValueError("Language must be specified")
 
-@app.get('/achievement/{achievement_id}')
-def get_achievement(id: int, language: Optional[db.Language]):
-    if language and language is not db.Lang.ALL:
-        db_achievement, db_translation = db.get_achievement(id, language)
-        achievement = achievement_db2type(db_achievement, db_translation, language)
-        return achievement
-    else:
-        db_achievement, db_translation = db.get_achievement(id, db.Lang.ALL)
-        achievement = achievement_db2type(db_achievement, db_translation, language)
-        return achievement
-
-@app.get('/achievement')
-def get_achievements(language: Optional[db.Language]):
-    db_achievements = db.get_achievements(language if language else db.Lang.ALL)
-    achievements = []
-    for db_achievement in db_achievements:
-        achievements.append(achievement_db2type(db_achievement[0], db_achievement[1], language))
-    return achievements
-
-@app.put('/achievement/translate/{achievement_id}')
-def update_achievement_translation(id: int, translation: AchievementTranslation):
-    db.translate_achievement(id, translation.language, translation.title, translation.description)
+@api.get('/achievement/{achievement_id}')
+async def get_achievement(request: Request, id: int, language: Optional[db.Language]):
+    async def build():
+        if language and language is not db.Lang.ALL:
+            db_achievement, db_translation = await store.get_achievement(id, language)
+        else:
+            db_achievement, db_translation = await store.get_achievement(id, db.Lang.ALL)
+        return achievement_db2type(db_achievement, db_translation, language)
+    return await conditional_response(request, [db.CATALOG_REVISION], build)
+
+def check_cursor(decode: Callable, cursor: Optional[str]) -> None:
+    """Reject a malformed `after` cursor with 400 before it reaches the store"""
+    if cursor:
+        try:
+            decode(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Invalid cursor')
+
+async def ndjson_pages(fetch_page: Callable, page: list, next_cursor: str, convert: Callable):
+    """NDJSON lines of `page` and of every page after it, fetched one at a time"""
+    while True:
+        yield ''.join(json.dumps(jsonable_encoder(convert(*item)), ensure_ascii=False) + '\n' for item in page)
+        if next_cursor is None:
+            return
+        page, next_cursor = await fetch_page(STREAM_PAGE_SIZE, next_cursor)
+
+async def listing_response(request: Request, revisions: list[str], fetch_page: Callable, convert: Callable,
+                           limit: Optional[int], after: Optional[str], format: str) -> Response:
+    """One page of `fetch_page(limit, after)` with the next cursor in X-Next-Cursor, or every page from `after` as NDJSON"""
+    if format == 'ndjson':
+        page, next_cursor = await fetch_page(limit or STREAM_PAGE_SIZE, after)
+        return StreamingResponse(ndjson_pages(fetch_page, page, next_cursor, convert), media_type='application/x-ndjson')
+    next_cursor = None
+    async def build():
+        nonlocal next_cursor
+        page, next_cursor = await fetch_page(limit or PAGE_SIZE, after)
+        return [convert(*item) for item in page]
+    response = await conditional_response(request, revisions, build)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+@api.get('/achievement')
+async def get_achievements(request: Request, language: Optional[db.Language], limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                           after: Optional[str] = None, format: Literal['json', 'ndjson'] = 'json'):
+    if limit is None and after is None and format == 'json':
+        async def build():
+            db_achievements = await store.get_achievements(language if language else db.Lang.ALL)
+            return [achievement_db2type(db_achievement, db_translation, language) for db_achievement, db_translation in db_achievements]
+        return await conditional_response(request, [db.CATALOG_REVISION], build)
+
+    async def fetch_page(size, cursor):
+        return await store.get_achievements_page(language if language else db.Lang.ALL, size, cursor)
+    def convert(db_achievement, db_translation):
+        return achievement_db2type(db_achievement, db_translation, language)
+    check_cursor(db.decode_achievement_cursor, after)
+    return await listing_response(request, [db.CATALOG_REVISION], fetch_page, convert, limit, after, format)
+
+@api.put('/achievement/translate/{achievement_id}')
+async def update_achievement_translation(id: int, translation: AchievementTranslation):
+    await store.translate_achievement(id, translation.language, translation.title, translation.description)
     return
 
-@app.post('/achievement/grant')
-def grant_user_achievement(achievement: UserAchievement):
+@api.post('/achievement/grant')
+async def grant_user_achievement(achievement: UserAchievement):
     if achievement.datetime:
-        db.grant_user_achievement(achievement.user_id, achievement.achievement_id, achievement.datetime)
+        await store.grant_user_achievement(achievement.user_id, achievement.achievement_id, achievement.datetime)
     else:
-        db.grant_user_achievement(achievement.user_id, achievement.achievement_id)
+        await store.grant_user_achievement(achievement.user_id, achievement.achievement_id)
     return
 
-@app.get('/achievements/{user_id}')
-def get_user_achievements(user_id: int):
-    db_achievements = db.get_user_achievements(user_id)
-    achievements: list[Achievement] = []
-    lang = db.get_user_language(user_id)
-    for db_achievement in db_achievements:
-        db_achievement, db_translation = db.get_achievement(db_achievement, lang)
-        achievements.append(achievement_db2type(db_achievement, db_translation, lang))
-    return achievements
-
-@app.get('/statistics/max_achievements')
-def get_user_with_max_achievements() -> dict:
-    user, count = db.get_user_with_max_achievements()
-    return {'user': UserStats(id=user.id, username=user.username, language=user.language, total_score=user.total_score, achievements=get_user_achievements(user.id)), 'count': count}
-
-@app.get('/statistics/max_score')
-def get_user_with_max_score() -> UserStats:
-    user = db.get_user_with_max_score()
-    return UserStats(id=user.id, username=user.username, language=user.language, total_score=user.total_score, achievements=get_user_achievements(user.id))
-
-@app.get('/statistics/max_diff')
-def get_users_with_max_diff() -> list[UserStats]:
-    users = db.get_users_with_max_score_diff()
-    return [UserStats(id=user.id, username=user.username, language=user.language, total_score=user.total_score, achievements=get_user_achievements(user.id)) for user in users]
-
-@app.get('/statistics/min_diff')
-def get_users_with_min_diff() -> list[UserStats]:
-    users = db.get_users_with_min_score_diff()
-    return [UserStats(id=user.id, username=user.username, language=user.language, total_score=user.total_score, achievements=None) for user in users]
-
-@app.get('/statistics/streak')
-def get_users_with_streak(limit: int = 10) -> list[UserStats]:
-    users = db.get_users_with_streak(7, limit)
-    return [UserStats(id=user.id, username=user.username, language=user.language, total_score=user.total_score, achievements=get_user_achievements(user.id)) for user in users]
-
-@app.get('/user/{user_id}')
-def get_user(user_id: int) -> UserFull:
-    user = db.get_user(user_id)
-    return UserFull(id=user.id, username=user.username, language=user.language, total_score=user.total_score, achievements=get_user_achievements(user_id))
\ No newline at end of file
+@api.post('/achievement/grant/batch')
+async def grant_user_achievements(batch: GrantBatchInput) -> list[GrantResult]:
+    statuses = await store.grant_user_achievements([(grant.user_id, grant.achievement_id, grant.date) for grant in batch.grants],
+                                          skip_duplicates=batch.skip_duplicates)
+    return [GrantResult(user_id=grant.user_id, achievement_id=grant.achievement_id, status=status)
+            for grant, status in zip(batch.grants, statuses)]
+
+async def user_profiles(user_ids: list[int]) -> dict[int, tuple]:
+    """Users by id with their achievements converted to API types, localized to each user's language"""
+    profiles = {}
+    for user_id, (user, db_achievements) in (await store.get_users_profiles(user_ids)).items():
+        language = db.Lang(user.language)
+        profiles[user_id] = (user, [achievement_db2type(db_achievement, db_translation, language)
+                                    for db_achievement, db_translation in db_achievements])
+    return profiles
+
+async def users_db2stats(users: list, with_achievements: bool = True) -> list[UserStats]:
+    profiles = await user_profiles([user.id for user in users]) if with_achievements else {}
+    return [UserStats(id=user.id, username=user.username, language=user.language, total_score=user.total_score,
+                      achievements=profiles[user.id][1] if with_achievements else None) for user in users]
+
+async def get_user_profile(user_id: int) -> tuple:
+    profile = (await user_profiles([user_id])).get(user_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f'User {user_id} not found')
+    return profile
+
+@api.get('/achievements/{user_id}')
+async def get_user_achievements(request: Request, user_id: int, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                                after: Optional[str] = None, order: Literal['asc', 'desc'] = 'asc',
+                                format: Literal['json', 'ndjson'] = 'json'):
+    revisions = [db.CATALOG_REVISION, db.user_revision(user_id)]
+    if limit is None and after is None and order == 'asc' and format == 'json':
+        async def build():
+            return (await get_user_profile(user_id))[1]
+        return await conditional_response(request, revisions, build)
+
+    async def fetch_page(size, cursor):
+        return await store.get_user_achievements_page(user_id, size, cursor, descending=order == 'desc')
+    def convert(db_achievement, db_translation, language, date):
+        achievement = achievement_db2type(db_achievement, db_translation, language)
+        # Users of language 'all' get every translation
+        granted = GrantedAchievementFull if isinstance(achievement, AchievementFull) else GrantedAchievement
+        return granted(**achievement.model_dump(), granted_at=date)
+    check_cursor(db.decode_grant_cursor, after)
+    try:
+        return await listing_response(request, revisions, fetch_page, convert, limit, after, format)
+    except db.User.DoesNotExist:
+        raise HTTPException(status_code=404, detail=f'User {user_id} not found')
+
+async def snapshot_response(key: Hashable, build: Callable, fresh: bool) -> Response:
+    """JSON response of `build()` from the statistics snapshot, with its age in seconds"""
+    async def compute():
+        return jsonable_encoder(await build())
+    value, age = await statistics.get(key, compute, fresh)
+    return JSONResponse(value, headers={'Age': str(int(age))})
+
+@statistics_api.get('/statistics/max_achievements')
+async def get_user_with_max_achievements(fresh: bool = False) -> dict:
+    async def build():
+        user, count = await store.get_user_with_max_achievements()
+        return {'user': (await users_db2stats([user]))[0], 'count': count}
+    return await snapshot_response(('max_achievements',), build, fresh)
+
+@statistics_api.get('/statistics/max_score')
+async def get_user_with_max_score(fresh: bool = False) -> UserStats:
+    async def build():
+        user = await store.get_user_with_max_score()
+        return (await users_db2stats([user]))[0]
+    return await snapshot_response(('max_score',), build, fresh)
+
+@statistics_api.get('/statistics/max_diff')
+async def get_users_with_max_diff(fresh: bool = False) -> list[UserStats]:
+    async def build():
+        users = await store.get_users_with_max_score_diff()
+        return await users_db2stats(users)
+    return await snapshot_response(('max_diff',), build, fresh)
+
+@statistics_api.get('/statistics/min_diff')
+async def get_users_with_min_diff(limit: Optional[int] = Query(None, ge=1, le=100), fresh: bool = False) -> list[ScorePair]:
+    async def build():
+        pairs = await store.get_users_with_min_score_diff(limit)
+        return [ScorePair(users=await users_db2stats([lower, higher], with_achievements=False), difference=difference)
+                for lower, higher, difference in pairs]
+    return await snapshot_response(('min_diff', limit), build, fresh)
+
+@statistics_api.get('/statistics/streak')
+async def get_users_with_streak(day_streak: int = 7, limit: int = 10, fresh: bool = False) -> list[UserStats]:
+    async def build():
+        users = await store.get_users_with_streak(day_streak, limit)
+        return await users_db2stats(users)
+    return await snapshot_response(('streak', day_streak, limit), build, fresh)
+
+def window_days(window: str = Query('7d', pattern=r'^[1-9][0-9]*d$')) -> int:
+    """Days of a `<n>d` window, ending today"""
+    days = int(window[:-1])
+    if days > MAX_WINDOW_DAYS:
+        raise HTTPException(status_code=422, detail=f'The window is at most {MAX_WINDOW_DAYS}d')
+    return days
+
+@statistics_api.get('/statistics/top')
+async def get_top_scorers(days: int = Depends(window_days), limit: int = Query(10, ge=1, le=100), fresh: bool = False) -> list[TopScorer]:
+    async def build():
+        scorers = await store.get_top_scorers(days, limit)
+        return [TopScorer(id=user.id, username=user.username, score=score, grants=grants) for user, score, grants in scorers]
+    return await snapshot_response(('top', days, limit), build, fresh)
+
+@api.get('/user/{user_id}')
+async def get_user(request: Request, user_id: int) -> UserFull:
+    async def build():
+        user, achievements = await get_user_profile(user_id)
+        return UserFull(id=user.id, username=user.username, language=user.language, total_score=user.total_score, achievements=achievements)
+    return await conditional_response(request, [db.CATALOG_REVISION, db.user_revision(user_id)], build)
+
+@api.get('/leaderboard')
+async def get_leaderboard(limit: int = Query(20, ge=1, le=100), after: Optional[str] = None) -> Leaderboard:
+    check_cursor(db.decode_leaderboard_cursor, after)
+    ranked, next_cursor = await store.get_leaderboard(limit, after)
+    return Leaderboard(items=[LeaderboardEntry(rank=rank, id=user.id, username=user.username, total_score=user.total_score,
+                                               achievement_count=user.achievement_count) for rank, user in ranked],
+                       next_cursor=next_cursor)
+
+@api.get('/user/{user_id}/rank')
+async def get_user_rank(user_id: int) -> UserRank:
+    try:
+        user, rank, lower, total = await store.get_user_rank(user_id)
+    except db.User.DoesNotExist:
+        raise HTTPException(status_code=404, detail=f'User {user_id} not found')
+    # Share of the other users scored strictly below this one
+    percentile = round(100 * lower / (total - 1), 2) if total > 1 else 100.0
+    return UserRank(id=user.id, total_score=user.total_score, rank=rank, percentile=percentile)
+
+@api.get('/user/{user_id}/activity')
+async def get_user_activity(user_id: int, days: int = Depends(window_days)) -> list[DailyActivity]:
+    try:
+        activity = await store.get_user_activity(user_id, days)
+    except db.User.DoesNotExist:
+        raise HTTPException(status_code=404, detail=f'User {user_id} not found')
+    return [DailyActivity(day=day, grants=grants, score=score) for day, grants, score in activity]
+
+async def change_stream(subscription: Subscription, keepalive: float = None):
+    """Server-sent events of `subscription`, ending with an 'overflow' or 'reset' event when the feed drops it"""
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), keepalive or CHANGES_KEEPALIVE)
+            except asyncio.TimeoutError:
+                # Keeps proxies from timing the stream out
+                yield ': keepalive\n\n'
+                continue
+            if event is None:
+                yield f'event: {subscription.closed}\ndata: {{}}\n\n'
+                return
+            yield f'event: {event["type"]}\ndata: {json.dumps(event)}\n\n'
+    finally:
+        changes.unsubscribe(subscription)
+
+@app.get('/events')
+async def get_events(user_id: Optional[int] = None, leaderboard: bool = False) -> StreamingResponse:
+    if user_id is None and not leaderboard:
+        raise HTTPException(status_code=400, detail='Subscribe to a user_id, to the leaderboard or to both')
+    subscription = await changes.subscribe(user_id, leaderboard)
+    return StreamingResponse(change_stream(subscription), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@api.get('/export')
+async def export_dataset() -> StreamingResponse:
+    # Always on the sync driver, streamed from a server-side cursor with a connection of its own
+    return StreamingResponse(db.export_ndjson(), media_type='application/x-ndjson')
+
+@api.post('/import')
+async def import_dataset(request: Request) -> dict:
+    with tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_SIZE) as body:
+        async for chunk in request.stream():
+            body.write(chunk)
+        body.seek(0)
+        try:
+            return await run_in_threadpool(db.import_records, db.read_records(body))
+        except ValueError as error:
+            raise HTTPException(status_code=400, detail=str(error))
+        except IntegrityError as error:
+            raise HTTPException(status_code=409, detail=str(error).strip())
+
+app.include_router(api)
+app.include_router(statistics_api)
@@ -0,0 +1,43 @@
+from prometheus_client import Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+
+import app.db_async as db_async
+from app.db import database, QueryStats
+from app.db_functions import achievement_cache
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency', ['method', 'route', 'status'])
+REQUEST_QUERIES = Histogram('http_request_db_queries', 'SQL statements run by an HTTP request', ['method', 'route'],
+                            buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100, 300, 1000))
+REQUEST_DB_TIME = Histogram('http_request_db_duration_seconds', 'Time an HTTP request spent in the database', ['method', 'route'])
+
+def observe_request(method: str, route: str, status: int, seconds: float, queries: QueryStats) -> None:
+    REQUEST_LATENCY.labels(method, route, str(status)).observe(seconds)
+    REQUEST_QUERIES.labels(method, route).observe(queries.count)
+    REQUEST_DB_TIME.labels(method, route).observe(queries.seconds)
+
+class StateCollector:
+    """Connection pool and achievement cache state, read when metrics are scraped"""
+    def collect(self):
+        pools = {'sync': database.stats()}
+        if db_async.pool is not None:
+            pools['async'] = db_async.stats()
+        connections = GaugeMetricFamily('db_pool_connections', 'Connections of the database pool by state', labels=['backend', 'state'])
+        max_size = GaugeMetricFamily('db_pool_max_size', 'Maximum size of the database pool', labels=['backend'])
+        created = CounterMetricFamily('db_pool_connections_created', 'Connections opened by the database pool', labels=['backend'])
+        for backend, stats in pools.items():
+            for state in ('in_use', 'idle', 'waiting'):
+                if state in stats:
+                    connections.add_metric([backend, state], stats[state])
+            max_size.add_metric([backend], stats['max_size'] or 0)
+            if 'created' in stats:
+                created.add_metric([backend], stats['created'])
+        yield connections
+        yield max_size
+        yield created
+
+        cache = achievement_cache.stats()
+        yield GaugeMetricFamily('achievement_cache_entries', 'Entries held by the achievement cache', value=cache['entries'])
+        for name in ('hits', 'misses', 'evictions'):
+            yield CounterMetricFamily(f'achievement_cache_{name}', f'Achievement cache {name}', value=cache[name])
+
+REGISTRY.register(StateCollector())
@@ -0,0 +1,126 @@
+"""Versioned schema migrations, applied in order by `python -m app.cli migrate` and recorded in `SchemaVersion`.
+
+Migrations run outside of a transaction, so that indexes can be built CONCURRENTLY while the tables are in use.
+Each one is idempotent: a migration that was interrupted is simply run again. Workers only check the version.
+"""
+import datetime
+import logging
+import re
+
+from peewee import Value, fn
+from playhouse.migrate import PostgresqlMigrator, migrate
+
+from app.db import (database, User, Achievement, AchievementTranslation, AchievementEn, AchievementRu, UserAchievement,
+                    UserStreak, UserActivity, Revision, SchemaVersion, recount_activity, recount_streaks,
+                    reconcile_scores_query, bump_revisions, user_revision)
+
+logger = logging.getLogger(__name__)
+
+# Tables of the first versioned schema
+BASELINE_MODELS = [User, Achievement, AchievementTranslation, UserAchievement, UserStreak, Revision]
+# Per-language translation tables of the first releases, by language
+LEGACY_TRANSLATION_MODELS = {'en': AchievementEn, 'ru': AchievementRu}
+# pg_advisory_lock key held while migrating, so that concurrent runs apply each migration once
+MIGRATION_LOCK = 20240501
+
+def add_missing_columns():
+    # Columns added after the first release, which create_table does not add to existing tables
+    columns = {column.name for column in database.get_columns(User._meta.table_name)}
+    if 'achievement_count' not in columns:
+        migrate(PostgresqlMigrator(database).add_column(User._meta.table_name, 'achievement_count', User.achievement_count))
+
+def migrate_translations():
+    # Move the rows of the per-language tables into AchievementTranslation, then drop them
+    for language, model in LEGACY_TRANSLATION_MODELS.items():
+        if not model.table_exists():
+            continue
+        with database.atomic():
+            (AchievementTranslation
+             .insert_from(model.select(model.id, Value(language), model.title, model.description),
+                          fields=[AchievementTranslation.achievement, AchievementTranslation.language,
+                                  AchievementTranslation.title, AchievementTranslation.description])
+             .on_conflict_ignore()
+             .execute())
+            model.drop_table()
+
+def create_tables():
+    """Tables of the baseline models without their indexes, upgrading the tables of releases older than the migrations"""
+    for model in BASELINE_MODELS:
+        model._schema.create_table(safe=True)
+    add_missing_columns()
+    migrate_translations()
+
+def create_index_concurrently(index) -> None:
+    name = index._name
+    # An interrupted concurrent build leaves an invalid index behind, which IF NOT EXISTS would keep
+    invalid = database.execute_sql('''SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+                                      WHERE pg_class.relname = %s AND NOT pg_index.indisvalid''', (name,)).fetchone()
+    if invalid:
+        database.execute_sql(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+    sql, params = database.get_sql_context().sql(index.safe(True)).query()
+    database.execute_sql(re.sub(r'^CREATE (UNIQUE )?INDEX', r'CREATE \1INDEX CONCURRENTLY', sql), params)
+
+def create_indexes(models: list = BASELINE_MODELS):
+    """Every index of `models`: the grant, streak and score indexes of the hot queries among the baseline ones"""
+    for model in models:
+        for index in model._meta.fields_to_index():
+            create_index_concurrently(index)
+
+def create_activity():
+    """UserActivity filled from the grant history, then its window index"""
+    UserActivity._schema.create_table(safe=True)
+    with database.atomic():
+        recount_activity()
+    create_indexes([UserActivity])
+
+def backfill_users():
+    """Scores, achievement counts and streaks recomputed from the grant history.
+
+    Releases older than the migrations had no `userstreak` and no `achievement_count`, which create_tables adds empty.
+    """
+    with database.atomic():
+        drifted = [user_id for user_id, *_ in reconcile_scores_query().tuples()]
+        bump_revisions(*map(user_revision, drifted))
+        recount_streaks()
+
+# (version, description, migration), in the order they are applied
+MIGRATIONS = [
+    (1, 'Tables', create_tables),
+    (2, 'Indexes, built concurrently', create_indexes),
+    (3, 'Daily activity rollup', create_activity),
+    (4, 'Scores, achievement counts and streaks from the grant history', backfill_users),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def schema_version() -> int:
+    """Version of the last migration applied, 0 for a database older than the migrations (or empty)"""
+    if not SchemaVersion.table_exists():
+        return 0
+    return SchemaVersion.select(fn.MAX(SchemaVersion.version)).scalar() or 0
+
+def apply_migrations() -> list[int]:
+    """Apply the pending migrations and return their versions; may run from several processes at once"""
+    applied = []
+    with database.connection_context():
+        database.execute_sql('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK,))
+        try:
+            SchemaVersion.create_table(safe=True)
+            current = schema_version()
+            for version, description, apply in MIGRATIONS:
+                if version <= current:
+                    continue
+                logger.info('Applying migration %d: %s', version, description)
+                apply()
+                SchemaVersion.create(version=version, description=description, applied_at=datetime.datetime.now())
+                applied.append(version)
+        finally:
+            database.execute_sql('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK,))
+    return applied
+
+def check_schema() -> None:
+    """Refuse to serve a database whose migrations are behind this code"""
+    with database.connection_context():
+        version = schema_version()
+    if version < LATEST_VERSION:
+        raise RuntimeError(f'Database schema is at version {version}, this code needs {LATEST_VERSION}: '
+                           'run `python -m app.cli migrate`')
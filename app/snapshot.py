@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+class Snapshot:
+    """Results of registered computations, refreshed together in one pass and served with their age.
+
+    An entry is current while `version()` has not changed since it was computed. While `run` is refreshing in the
+    background, outdated entries are still served for up to `max_age` seconds, otherwise they are recomputed on read.
+    At most `max_entries` keys are kept, least recently requested first out, and a key not requested for `max_idle`
+    seconds is dropped instead of being refreshed.
+    """
+    def __init__(self, version: Callable[[], int], max_age: float, refresh_interval: float, max_entries: int = 64,
+                 max_idle: float = 300):
+        self.version = version
+        self.max_age = max_age
+        self.refresh_interval = refresh_interval
+        self.max_entries = max_entries
+        self.max_idle = max_idle
+        self.running = False
+        # key -> [compute, (value, monotonic time computed, version) or None, monotonic time last requested],
+        # least recently requested first
+        self._entries = OrderedDict()
+
+    def _usable(self, entry) -> bool:
+        if entry is None:
+            return False
+        value, computed_at, version = entry
+        return version == self.version() or (self.running and time.monotonic() - computed_at <= self.max_age)
+
+    async def _compute(self, key: Hashable, compute: Callable[[], Awaitable]):
+        version = self.version()
+        entry = (await compute(), time.monotonic(), version)
+        # Not stored for a key evicted meanwhile
+        if key in self._entries:
+            self._entries[key][1] = entry
+        return entry
+
+    async def get(self, key: Hashable, compute: Callable[[], Awaitable], fresh: bool = False) -> tuple[object, float]:
+        """(value, age in seconds) of `key`, computing it now when forced, missing or too old"""
+        registered = self._entries.get(key)
+        if registered is None:
+            registered = self._entries[key] = [compute, None, 0]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        self._entries.move_to_end(key)
+        registered[2] = time.monotonic()
+        entry = registered[1]
+        if fresh or not self._usable(entry):
+            entry = await self._compute(key, compute)
+        return entry[0], time.monotonic() - entry[1]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def _expire(self) -> None:
+        # Drop the keys not requested for max_idle seconds, which come first
+        now = time.monotonic()
+        while self._entries and now - next(iter(self._entries.values()))[2] > self.max_idle:
+            self._entries.popitem(last=False)
+
+    async def refresh(self) -> None:
+        """Recompute every registered entry"""
+        self._expire()
+        for key, (compute, _, _) in list(self._entries.items()):
+            try:
+                await self._compute(key, compute)
+            except Exception:
+                logger.exception('Failed to refresh %r', key)
+                if key in self._entries:
+                    self._entries[key][1] = None
+
+    def due(self) -> bool:
+        """Whether some entry is outdated, or will be older than `max_age` before the next check"""
+        self._expire()
+        now = time.monotonic()
+        return any(entry is not None and (entry[2] != self.version() or now - entry[1] + self.refresh_interval >= self.max_age)
+                   for _, entry, _ in self._entries.values())
+
+    async def run(self) -> None:
+        """Refresh in the background, `refresh_interval` seconds after a change at most; runs until cancelled"""
+        self.running = True
+        try:
+            while True:
+                await asyncio.sleep(self.refresh_interval)
+                if self.due():
+                    await self.refresh()
+        finally:
+            self.running = False
@@ -0,0 +1,58 @@
+import argparse
+import asyncio
+import json
+import pathlib
+import time
+
+from bench.run import ENDPOINTS, run_endpoints, environment
+from bench.seed import seed
+
+def dataset_size(value: str) -> tuple[int, int, int]:
+    try:
+        users, achievements, grants = (int(part) for part in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected USERS,ACHIEVEMENTS,GRANTS')
+    return users, achievements, grants
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench',
+                                     description='Seed the database at DB_URL (its tables are dropped!) and measure every endpoint')
+    parser.add_argument('--size', type=dataset_size, action='append', metavar='USERS,ACHIEVEMENTS,GRANTS',
+                        help='Dataset size, repeat for several (default: 1000,50,10000 and 10000,200,100000)')
+    parser.add_argument('--endpoint', action='append', choices=list(ENDPOINTS), help='Endpoint to measure, repeat for several (default: all)')
+    parser.add_argument('--backend', choices=['sync', 'async'], default='sync', help='Data access backend, as DB_BACKEND')
+    parser.add_argument('--requests', type=int, default=200, help='Measured requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=20, help='Unmeasured requests per endpoint before measuring')
+    parser.add_argument('--concurrency', type=int, default=8, help='Requests in flight at once')
+    parser.add_argument('--days', type=int, default=90, help='Grants are spread over this many past days')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the dataset and of the requested ids')
+    parser.add_argument('--output', type=pathlib.Path, help='Results file (default: bench/results/<time>-<commit>-<backend>.json)')
+    args = parser.parse_args(argv)
+
+    sizes = args.size or [(1000, 50, 10000), (10000, 200, 100000)]
+    endpoints = args.endpoint or list(ENDPOINTS)
+    results = environment(args.backend, args.requests, args.warmup, args.concurrency, args.seed)
+    results['runs'] = []
+    for users, achievements, grants in sizes:
+        print(f'Seeding {users} users, {achievements} achievements, {grants} grants...')
+        start = time.perf_counter()
+        seed(users, achievements, grants, days=args.days, seed=args.seed)
+        seed_seconds = round(time.perf_counter() - start, 2)
+        measured = asyncio.run(run_endpoints(endpoints, args.requests, args.warmup, args.concurrency, args.backend, args.seed))
+        results['runs'].append({'users': users, 'achievements': achievements, 'grants': grants,
+                                'seed_seconds': seed_seconds, 'endpoints': measured})
+        print(f'{"endpoint":<30} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"req/s":>9} {"queries":>8} {"errors":>7}')
+        for name, result in measured.items():
+            print(f'{name:<30} {result["p50_ms"]:>9} {result["p95_ms"]:>9} {result["p99_ms"]:>9} '
+                  f'{result["throughput_rps"]:>9} {result["queries_per_request"]:>8} {result["errors"]:>7}')
+
+    output = args.output
+    if output is None:
+        commit = (results['commit'] or 'unknown')[:12]
+        output = pathlib.Path('bench/results') / f'{time.strftime("%Y%m%dT%H%M%S")}-{commit}-{args.backend}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2, ensure_ascii=False))
+    print(f'Results written to {output}')
+
+if __name__ == '__main__':
+    main()
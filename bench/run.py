@@ -0,0 +1,106 @@
+import asyncio
+import datetime
+import platform
+import random
+import statistics
+import subprocess
+import time
+
+import httpx
+
+import app.db_async as db_async
+import app.main as main
+from app.db import database, User, Achievement
+
+# Endpoint name -> path of one request, given a random generator and the seeded user and achievement ids
+ENDPOINTS = {
+    '/user/{id}': lambda rng, users, achievements: f'/user/{rng.choice(users)}',
+    '/user/{id}/rank': lambda rng, users, achievements: f'/user/{rng.choice(users)}/rank',
+    '/achievements/{id}': lambda rng, users, achievements: f'/achievements/{rng.choice(users)}',
+    '/achievement/{id}': lambda rng, users, achievements: f'/achievement/{(id := rng.choice(achievements))}?id={id}&language=en',
+    '/achievement': lambda rng, users, achievements: '/achievement?language=all',
+    '/leaderboard': lambda rng, users, achievements: '/leaderboard',
+    '/statistics/max_achievements': lambda rng, users, achievements: '/statistics/max_achievements',
+    '/statistics/max_score': lambda rng, users, achievements: '/statistics/max_score',
+    '/statistics/max_diff': lambda rng, users, achievements: '/statistics/max_diff',
+    '/statistics/min_diff': lambda rng, users, achievements: '/statistics/min_diff',
+    '/statistics/streak': lambda rng, users, achievements: '/statistics/streak?day_streak=3',
+    '/statistics/top': lambda rng, users, achievements: '/statistics/top?window=7d',
+    '/user/{id}/activity': lambda rng, users, achievements: f'/user/{rng.choice(users)}/activity?window=30d',
+}
+
+def percentile(latencies: list[float], percent: int) -> float:
+    return statistics.quantiles(latencies, n=100, method='inclusive')[percent - 1] if len(latencies) > 1 else latencies[0]
+
+async def measure(client: httpx.AsyncClient, paths: list[str], concurrency: int) -> dict:
+    """Latency percentiles (ms), throughput and SQL statements per request for `paths` requested `concurrency` at a time"""
+    latencies = []
+    errors = 0
+    queries = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request(path):
+        nonlocal errors, queries
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.get(path)
+            latencies.append((time.perf_counter() - start) * 1000)
+            errors += response.status_code >= 400
+            queries += int(response.headers['X-DB-Queries'])
+
+    start = time.perf_counter()
+    await asyncio.gather(*[request(path) for path in paths])
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': len(paths),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(statistics.fmean(latencies), 3),
+        'throughput_rps': round(len(paths) / elapsed, 1),
+        'queries_per_request': round(queries / len(paths), 2),
+    }
+
+async def run_endpoints(endpoints: list[str], requests: int, warmup: int, concurrency: int, backend: str, seed: int) -> dict:
+    with database.connection_context():
+        users = [user_id for user_id, in User.select(User.id).tuples()]
+        achievements = [achievement_id for achievement_id, in Achievement.select(Achievement.id).tuples()]
+    rng = random.Random(seed)
+    results = {}
+    # Query counts are read from the X-DB-Queries header
+    store, query_headers = main.store, main.QUERY_HEADERS
+    main.store = db_async if backend == 'async' else main.ThreadpoolBackend()
+    main.QUERY_HEADERS = True
+    try:
+        async with main.lifespan(main.app):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url='http://bench') as client:
+                for name in endpoints:
+                    path = ENDPOINTS[name]
+                    for _ in range(warmup):
+                        await client.get(path(rng, users, achievements))
+                    results[name] = await measure(client, [path(rng, users, achievements) for _ in range(requests)], concurrency)
+    finally:
+        main.store, main.QUERY_HEADERS = store, query_headers
+    return results
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+def environment(backend: str, requests: int, warmup: int, concurrency: int, seed: int) -> dict:
+    return {
+        'commit': git_commit(),
+        'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'backend': backend,
+        'requests': requests,
+        'warmup': warmup,
+        'concurrency': concurrency,
+        'seed': seed,
+    }
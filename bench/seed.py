@@ -0,0 +1,49 @@
+import datetime
+import itertools
+import random
+
+from peewee import chunked
+
+import app.db_functions as db
+from app.db import database, User, Achievement, AchievementTranslation
+
+INSERT_BATCH_SIZE = 5000
+# Grants handed to grant_user_achievements per transaction
+GRANT_CHUNK_SIZE = 50000
+
+def grant_date(rng: random.Random, now: datetime.datetime, days: int) -> datetime.datetime:
+    """A moment within the last `days` days, recent days being the busiest"""
+    days_ago = min(int(rng.expovariate(1 / max(days / 6, 1))), days - 1)
+    return now - datetime.timedelta(days=days_ago, seconds=rng.randrange(24 * 60 * 60))
+
+def seed(users: int, achievements: int, grants: int, days: int = 90, seed: int = 0) -> None:
+    """Recreate the schema and fill it with a reproducible dataset: the same arguments give the same rows.
+
+    Users and achievements (with EN and RU translations) are bulk inserted; grants go through
+    `grant_user_achievements`, so scores, streaks and revisions are maintained as in production.
+    """
+    rng = random.Random(seed)
+    db.drop_db()
+    db.create_db()
+    with database.connection_context(), database.atomic():
+        for chunk in chunked(range(1, users + 1), INSERT_BATCH_SIZE):
+            User.insert_many([(f'user{i}', rng.choice(['en', 'ru']), 0, 0) for i in chunk],
+                             fields=[User.username, User.language, User.total_score, User.achievement_count]).execute()
+        for chunk in chunked(range(1, achievements + 1), INSERT_BATCH_SIZE):
+            Achievement.insert_many([(rng.randint(1, 100),) for _ in chunk], fields=[Achievement.score]).execute()
+        user_ids = [user_id for user_id, in User.select(User.id).order_by(User.id).tuples()]
+        achievement_ids = [achievement_id for achievement_id, in Achievement.select(Achievement.id).order_by(Achievement.id).tuples()]
+        for chunk in chunked(achievement_ids, INSERT_BATCH_SIZE):
+            AchievementTranslation.insert_many([row for i in chunk for row in ((i, 'en', f'Achievement {i}', f'Description of achievement {i}'),
+                                                                               (i, 'ru', f'Достижение {i}', f'Описание достижения {i}'))],
+                                               fields=[AchievementTranslation.achievement, AchievementTranslation.language,
+                                                       AchievementTranslation.title, AchievementTranslation.description]).execute()
+    if not user_ids or not achievement_ids:
+        return
+    now = datetime.datetime.now()
+    # A small share of users earns most of the grants, as in a real player base
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(user_ids) + 1)))
+    for start in range(0, grants, GRANT_CHUNK_SIZE):
+        size = min(GRANT_CHUNK_SIZE, grants - start)
+        db.grant_user_achievements([(user_id, rng.choice(achievement_ids), grant_date(rng, now, days))
+                                    for user_id in rng.choices(user_ids, cum_weights=weights, k=size)])
@@ -1,14 +1,38 @@
+import asyncio
+import json
+import logging
 import pytest
+from contextlib import contextmanager
 from fastapi.testclient import TestClient
+from playhouse.pool import MaxConnectionsExceeded
+import app.main as main
+import app.db as app_db
+import app.db_functions as db_functions
+import app.db_async as db_async
+import app.migrations as migrations
 from app.main import app
-from app.db_functions import create_db, drop_db, create_user, grant_user_achievement, create_achievement, Lang
+from app.cache import LRUCache
+from app.feed import ChangeFeed
+from app.snapshot import Snapshot
+from app.db import database, User, UserAchievement, Achievement, AchievementEn, AchievementRu
+from bench.run import run_endpoints
+from bench.seed import seed
+from app.db_functions import create_db, drop_db, create_user, grant_user_achievement, grant_user_achievements, create_achievement, translate_achievement, get_user, reconcile_scores, rebuild_streaks, rebuild_activity, achievement_cache, Lang
 import datetime
 
-from peewee import PostgresqlDatabase
-database = PostgresqlDatabase('test_elvis_test', user='elvis_test', password="hackme12345")
-
 client = TestClient(app)
 
+@contextmanager
+def count_queries(monkeypatch):
+    queries = []
+    execute_sql = database.execute_sql
+    def counting_execute_sql(sql, params=None, *args, **kwargs):
+        queries.append(sql)
+        return execute_sql(sql, params, *args, **kwargs)
+    with monkeypatch.context() as m:
+        m.setattr(database, 'execute_sql', counting_execute_sql)
+        yield queries
+
 @pytest.fixture(scope="module", autouse=True)
 def setup_and_teardown():
     create_db()
@@ -18,9 +42,9 @@ def setup_and_teardown():
 @pytest.fixture(autouse=True)
 def transaction():
     create_db()
+    main.statistics.clear()
     yield
-    database.rollback()
-    database.close()
+    drop_db()
 
 def test_read_root():
     response = client.get("/")
@@ -124,4 +148,813 @@ def test_get_user():
     assert "username" in response.json()
     assert "language" in response.json()
     assert "total_score" in response.json()
-    assert "achievements" in response.json()
\ No newline at end of file
+    assert "achievements" in response.json()
+
+def test_get_achievements_query_count(monkeypatch):
+    query_counts = {}
+    catalog_size = 0
+    for target_size in (3, 30):
+        for _ in range(target_size - catalog_size):
+            achievement_id = create_achievement(10)
+            translate_achievement(achievement_id, Lang.EN, f'Title {achievement_id}', 'Description')
+        catalog_size = target_size
+        with count_queries(monkeypatch) as queries:
+            response = client.get("/achievement", params={"language": "all"})
+        assert response.status_code == 200
+        assert len(response.json()) == catalog_size
+        assert response.json()[0]["translations"][0]["language"] == "en"
+        query_counts[catalog_size] = len(queries)
+    # Revision lookup for the ETag, then the catalog itself
+    assert query_counts[3] == query_counts[30] == 2
+
+def test_request_uses_single_pooled_connection(monkeypatch):
+    user_id = create_user('testuser', Lang.EN)
+    for _ in range(3):
+        achievement_id = create_achievement(10)
+        translate_achievement(achievement_id, Lang.EN, 'Title', 'Description')
+        grant_user_achievement(user_id, achievement_id)
+    checkouts = []
+    connect = database.connect
+    monkeypatch.setattr(database, 'connect', lambda *args, **kwargs: checkouts.append(1) or connect(*args, **kwargs))
+    created = database.stats()['created']
+    for _ in range(3):
+        response = client.get(f"/achievements/{user_id}")
+        assert response.status_code == 200
+        assert len(response.json()) == 3
+    assert len(checkouts) == 3
+    assert database.stats()['created'] == created
+    assert database.stats()['in_use'] == 0
+
+def test_grant_increments_total_score(monkeypatch):
+    user_id = create_user('testuser', Lang.EN)
+    for score in (5, 7):
+        grant_user_achievement(user_id, create_achievement(score))
+    achievement_id = create_achievement(3)
+    with count_queries(monkeypatch) as queries:
+        grant_user_achievement(user_id, achievement_id)
+    assert len([sql for sql in queries if sql.startswith('UPDATE')]) == 1
+    assert not any('SUM' in sql for sql in queries)
+    assert get_user(user_id).total_score == 15
+
+def test_reconcile_scores():
+    user_id = create_user('testuser', Lang.EN)
+    other_id = create_user('testuser2', Lang.EN)
+    grant_user_achievement(user_id, create_achievement(5))
+    with database.connection_context():
+        User.update(total_score=100).execute()
+        User.update(achievement_count=3).where(User.id == other_id).execute()
+    assert sorted(reconcile_scores(dry_run=True)) == [(user_id, 100, 5, 1, 1), (other_id, 100, 0, 3, 0)]
+    assert get_user(user_id).total_score == 100
+    assert sorted(reconcile_scores()) == [(user_id, 100, 5, 1, 1), (other_id, 100, 0, 3, 0)]
+    assert get_user(user_id).total_score == 5
+    assert get_user(other_id).achievement_count == 0
+    assert reconcile_scores() == []
+
+def test_grant_user_achievements_batch(monkeypatch):
+    user_id = create_user('testuser', Lang.EN)
+    other_id = create_user('testuser2', Lang.EN)
+    first_id, second_id = create_achievement(5), create_achievement(7)
+    grant_user_achievement(user_id, first_id)
+    grants = [
+        {"user_id": user_id, "achievement_id": first_id},
+        {"user_id": user_id, "achievement_id": second_id},
+        {"user_id": other_id, "achievement_id": second_id},
+        {"user_id": other_id, "achievement_id": second_id},
+        {"user_id": other_id, "achievement_id": 0},
+        {"user_id": 0, "achievement_id": first_id},
+    ]
+    with count_queries(monkeypatch) as queries:
+        response = client.post("/achievement/grant/batch", json={"grants": grants, "skip_duplicates": True})
+    assert response.status_code == 200
+    assert [item["status"] for item in response.json()] == ['duplicate', 'granted', 'granted', 'duplicate', 'unknown_achievement', 'unknown_user']
+    assert len([sql for sql in queries if sql.startswith('INSERT INTO "userachievement"')]) == 1
+    assert len([sql for sql in queries if sql.startswith('UPDATE')]) == 1
+    assert get_user(user_id).total_score == 12
+    assert get_user(other_id).total_score == 7
+
+    response = client.post("/achievement/grant/batch", json={"grants": grants[:2]})
+    assert [item["status"] for item in response.json()] == ['granted', 'granted']
+    assert get_user(user_id).total_score == 24
+
+def test_user_profile_query_count(monkeypatch):
+    query_counts = {}
+    for username, grants in (('testuser', 2), ('testuser2', 20)):
+        user_id = create_user(username, Lang.RU)
+        for _ in range(grants):
+            achievement_id = create_achievement(10)
+            translate_achievement(achievement_id, Lang.RU, 'Заголовок', 'Описание')
+            grant_user_achievement(user_id, achievement_id)
+        for cache in ('cold', 'warm'):
+            with count_queries(monkeypatch) as queries:
+                response = client.get(f"/user/{user_id}")
+            assert response.status_code == 200
+            assert len(response.json()["achievements"]) == grants
+            assert response.json()["achievements"][0]["translation"]["language"] == "ru"
+            query_counts[grants, cache] = len(queries)
+    # Revisions, users, grants and (when cold) achievements
+    assert query_counts[2, 'cold'] == query_counts[20, 'cold'] == 4
+    assert query_counts[2, 'warm'] == query_counts[20, 'warm'] == 3
+
+    with count_queries(monkeypatch) as queries:
+        response = client.get("/statistics/max_diff")
+    assert response.status_code == 200
+    assert [len(user["achievements"]) for user in response.json()] == [20, 2]
+    assert len(queries) <= 4
+
+def test_get_missing_user():
+    assert client.get("/user/0").status_code == 404
+    assert client.get("/achievements/0").status_code == 404
+
+def test_streak_maintained_on_grant():
+    now = datetime.datetime.now()
+    streaker_id = create_user('testuser', Lang.EN)
+    broken_id = create_user('testuser2', Lang.EN)
+    achievement_id = create_achievement(1)
+    # Granted oldest first, with a second grant on the same day
+    for days_ago in (3, 2, 2, 1, 0):
+        grant_user_achievement(streaker_id, achievement_id, now - datetime.timedelta(days=days_ago))
+    for days_ago in (4, 3, 1, 0):
+        grant_user_achievement(broken_id, achievement_id, now - datetime.timedelta(days=days_ago))
+
+    response = client.get("/statistics/streak", params={"day_streak": 2, "limit": 0})
+    assert [user["id"] for user in response.json()] == [streaker_id, broken_id]
+    response = client.get("/statistics/streak", params={"day_streak": 3})
+    assert [user["id"] for user in response.json()] == [streaker_id]
+
+    # A backdated grant filling the gap joins the two runs
+    grant_user_achievement(broken_id, achievement_id, now - datetime.timedelta(days=2))
+    response = client.get("/statistics/streak", params={"day_streak": 5})
+    assert [user["id"] for user in response.json()] == [broken_id]
+    assert rebuild_streaks() == 2
+    response = client.get("/statistics/streak", params={"day_streak": 4, "limit": 0})
+    assert [user["id"] for user in response.json()] == [broken_id, streaker_id]
+
+def test_score_diff_statistics():
+    scores = {'first': 10, 'second': 13, 'third': 14, 'fourth': 20, 'fifth': 21}
+    user_ids = {}
+    for username, score in scores.items():
+        user_ids[username] = create_user(username, Lang.EN)
+        grant_user_achievement(user_ids[username], create_achievement(score))
+
+    response = client.get("/statistics/min_diff")
+    assert response.status_code == 200
+    pairs = [([user["id"] for user in pair["users"]], pair["difference"]) for pair in response.json()]
+    assert pairs == [([user_ids['second'], user_ids['third']], 1), ([user_ids['fourth'], user_ids['fifth']], 1)]
+
+    response = client.get("/statistics/min_diff", params={"limit": 3})
+    assert [pair["difference"] for pair in response.json()] == [1, 1, 3]
+    for limit in (-1, 0, 101):
+        assert client.get("/statistics/min_diff", params={"limit": limit}).status_code == 422
+
+    response = client.get("/statistics/max_diff")
+    assert [user["id"] for user in response.json()] == [user_ids['fifth'], user_ids['first']]
+
+def test_leaderboard(monkeypatch):
+    scores = [('first', [30]), ('second', [20, 10]), ('third', [20, 10]), ('fourth', [25]), ('fifth', [])]
+    user_ids = {}
+    for username, user_scores in scores:
+        user_ids[username] = create_user(username, Lang.EN)
+        for score in user_scores:
+            grant_user_achievement(user_ids[username], create_achievement(score))
+
+    pages, after = [], None
+    while True:
+        response = client.get("/leaderboard", params={"limit": 2, **({"after": after} if after else {})})
+        assert response.status_code == 200
+        pages.append([(item["rank"], item["id"]) for item in response.json()["items"]])
+        after = response.json()["next_cursor"]
+        if after is None:
+            break
+    assert pages == [[(1, user_ids['third']), (1, user_ids['second'])],
+                     [(1, user_ids['first']), (4, user_ids['fourth'])],
+                     [(5, user_ids['fifth'])]]
+    assert client.get("/leaderboard", params={"after": "garbage"}).status_code == 400
+    # Only a malformed cursor is a client error, not any ValueError raised by the store
+    def exhausted(*args, **kwargs):
+        raise MaxConnectionsExceeded('Exceeded maximum connections.')
+    monkeypatch.setattr(main.store, "get_leaderboard", exhausted)
+    assert TestClient(app, raise_server_exceptions=False).get("/leaderboard").status_code == 500
+
+    response = client.get("/statistics/max_achievements")
+    assert response.json()["user"]["id"] == user_ids['third']
+    assert response.json()["count"] == 2
+
+    response = client.get(f"/user/{user_ids['fourth']}/rank")
+    assert response.json()["rank"] == 4
+    assert response.json()["percentile"] == 25.0
+    assert client.get("/user/0/rank").status_code == 404
+
+def test_achievement_cache(monkeypatch):
+    user_id = create_user('testuser', Lang.EN)
+    achievement_id = create_achievement(10)
+    translate_achievement(achievement_id, Lang.EN, 'Title', 'Description')
+    grant_user_achievement(user_id, achievement_id)
+    client.get("/achievement", params={"language": "all"})
+
+    hits = achievement_cache.stats()['hits']
+    with count_queries(monkeypatch) as queries:
+        response = client.get("/achievement", params={"language": "en"})
+        assert response.json()[0]["translation"]["title"] == 'Title'
+        response = client.get(f"/achievements/{user_id}")
+        assert response.json()[0]["translation"]["title"] == 'Title'
+    assert not any(table in sql for sql in queries for table in ('"achievement"', '"achievementen"', '"achievementru"'))
+    assert achievement_cache.stats()['hits'] > hits
+
+    response = client.put(f"/achievement/translate/{achievement_id}", params={"id": achievement_id},
+                          json={"language": "en", "title": "New title", "description": "Description"})
+    assert response.status_code == 200
+    assert client.get(f"/achievements/{user_id}").json()[0]["translation"]["title"] == 'New title'
+    create_achievement(5)
+    assert len(client.get("/achievement", params={"language": "en"}).json()) == 2
+
+def test_lru_cache_eviction():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get_many(['a', 'b', 'c']) == {'a': 1, 'c': 3}
+    assert cache.stats() == {'entries': 2, 'max_entries': 2, 'hits': 3, 'misses': 1, 'evictions': 1}
+    # A fill read before a clear or invalidation is dropped
+    generation = cache.generation
+    cache.clear()
+    cache.set_many({'a': 1}, generation)
+    assert cache.get('a') is None
+    generation = cache.generation
+    cache.invalidate('b')
+    cache.set('a', 1, generation)
+    assert cache.get('a') is None
+    cache.set('a', 1, cache.generation)
+    assert cache.get('a') == 1
+
+def test_conditional_get(monkeypatch):
+    user_id = create_user('testuser', Lang.EN)
+    achievement_id = create_achievement(10)
+    translate_achievement(achievement_id, Lang.EN, 'Title', 'Description')
+    grant_user_achievement(user_id, achievement_id)
+
+    for url in (f"/user/{user_id}", f"/achievements/{user_id}", "/achievement?language=en"):
+        response = client.get(url)
+        assert response.status_code == 200
+        etag = response.headers["etag"]
+        assert response.headers["last-modified"]
+        with count_queries(monkeypatch) as queries:
+            response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b''
+        assert response.headers["etag"] == etag
+        assert len(queries) == 1
+        response = client.get(url, headers={"If-Modified-Since": response.headers["last-modified"]})
+        assert response.status_code == 304
+
+    response = client.get(f"/user/{user_id}")
+    etag, last_modified = response.headers["etag"], response.headers["last-modified"]
+    assert client.get("/achievement?language=ru", headers={"If-None-Match": client.get("/achievement?language=en").headers["etag"]}).status_code == 200
+    grant_user_achievement(user_id, achievement_id)
+    response = client.get(f"/user/{user_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["total_score"] == 20
+    etag = response.headers["etag"]
+    translate_achievement(achievement_id, Lang.EN, 'New title', 'Description')
+    response = client.get(f"/user/{user_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["achievements"][0]["translation"]["title"] == 'New title'
+
+    # A translation updated by another worker: this process's cache only learns of it from the catalog revision
+    response = client.get(f"/achievement/{achievement_id}", params={"id": achievement_id, "language": "en"})
+    assert response.json()["translation"]["title"] == 'New title'
+    with database.atomic():
+        app_db.AchievementTranslation.update(title='Other title').where(app_db.AchievementTranslation.achievement == achievement_id).execute()
+        app_db.bump_revisions(app_db.CATALOG_REVISION)
+    response = client.get(f"/achievement/{achievement_id}", params={"id": achievement_id, "language": "en"},
+                          headers={"If-None-Match": response.headers["etag"]})
+    assert response.status_code == 200
+    assert response.json()["translation"]["title"] == 'Other title'
+
+def test_async_backend_matches_sync(monkeypatch):
+    now = datetime.datetime.now()
+    monkeypatch.setattr(main, 'store', db_async)
+    with TestClient(app) as async_client:
+        user_ids = [async_client.post("/user", json={"username": username, "language": "ru"}).json()["id"]
+                    for username in ('testuser', 'testuser2', 'testuser3')]
+        achievement_ids = [async_client.post("/achievement", json={"score": score, "translations": [
+                               {"language": "ru", "title": f"Заголовок {score}", "description": "Описание"}]}).json()["id"]
+                           for score in (5, 7, 9)]
+        for days_ago in (0, 2, 1):
+            response = async_client.post("/achievement/grant", json={"user_id": user_ids[0], "achievement_id": achievement_ids[0],
+                                                                     "datetime": (now - datetime.timedelta(days=days_ago)).isoformat(), "translation": None})
+            assert response.status_code == 200
+        grants = [{"user_id": user_ids[1], "achievement_id": achievement_id} for achievement_id in achievement_ids]
+        response = async_client.post("/achievement/grant/batch", json={"grants": grants + [{"user_id": 0, "achievement_id": 1}]})
+        assert [item["status"] for item in response.json()] == ['granted', 'granted', 'granted', 'unknown_user']
+        assert get_user(user_ids[0]).total_score == 15
+        assert get_user(user_ids[1]).achievement_count == 3
+
+        urls = [f"/user/{user_ids[0]}", f"/achievements/{user_ids[1]}", f"/achievement/{achievement_ids[1]}?id={achievement_ids[1]}&language=ru",
+                "/achievement?language=all", "/statistics/max_achievements", "/statistics/max_score", "/statistics/max_diff",
+                "/statistics/min_diff?limit=2", "/statistics/streak?day_streak=3", "/leaderboard?limit=2", f"/user/{user_ids[2]}/rank",
+                "/statistics/top?window=2d", f"/user/{user_ids[0]}/activity?window=3d"]
+        async_responses = [async_client.get(url) for url in urls]
+        assert async_client.get("/user/0").status_code == 404
+        assert async_client.get("/user/0/rank").status_code == 404
+        response = async_client.get(urls[0], headers={"If-None-Match": async_responses[0].headers["etag"]})
+        assert response.status_code == 304
+    assert db_async.pool is None
+
+    monkeypatch.undo()
+    for url, async_response in zip(urls, async_responses):
+        response = client.get(url)
+        assert async_response.status_code == response.status_code == 200
+        assert async_response.json() == response.json(), url
+    assert async_responses[8].json()[0]["id"] == user_ids[0]
+
+def test_benchmark_seed_and_measure():
+    seed(30, 5, 300, days=10, seed=1)
+    with database.connection_context():
+        users = list(User.select(User.username, User.total_score).order_by(User.id).tuples())
+        assert UserAchievement.select().count() == 300
+    assert reconcile_scores(dry_run=True) == []
+    seed(30, 5, 300, days=10, seed=1)
+    with database.connection_context():
+        assert list(User.select(User.username, User.total_score).order_by(User.id).tuples()) == users
+
+    results = asyncio.run(run_endpoints(['/user/{id}', '/statistics/max_diff'], requests=5, warmup=1, concurrency=2, backend='sync', seed=1))
+    assert results['/user/{id}']['requests'] == 5
+    assert results['/user/{id}']['errors'] == 0
+    assert results['/user/{id}']['queries_per_request'] == 3
+    assert results['/statistics/max_diff']['p50_ms'] <= results['/statistics/max_diff']['p99_ms']
+
+def test_query_instrumentation(monkeypatch, caplog):
+    user_id = create_user('testuser', Lang.EN)
+    grant_user_achievement(user_id, create_achievement(10))
+    assert "X-DB-Queries" not in client.get(f"/user/{user_id}").headers
+
+    monkeypatch.setattr(main, 'QUERY_HEADERS', True)
+    with count_queries(monkeypatch) as queries:
+        response = client.get(f"/user/{user_id}")
+    assert response.headers["X-DB-Queries"] == str(len(queries)) == "3"
+    assert float(response.headers["X-DB-Time"]) > 0
+    monkeypatch.setattr(main, 'store', db_async)
+    with TestClient(app) as async_client:
+        achievement_cache.clear()
+        assert async_client.get(f"/user/{user_id}").headers["X-DB-Queries"] == "4"
+        assert async_client.get(f"/user/{user_id}").headers["X-DB-Queries"] == "3"
+        monkeypatch.setattr(app_db, 'SLOW_QUERY_MS', 0)
+        with caplog.at_level(logging.WARNING, logger='app.db'):
+            async_client.get("/statistics/max_score", params={"fresh": True})
+        assert any('Slow query' in record.message and '"user"' in record.message for record in caplog.records)
+
+        metrics = async_client.get("/metrics").text
+    assert 'http_request_duration_seconds_count{method="GET",route="/user/{user_id}",status="200"}' in metrics
+    assert 'http_request_db_queries_bucket{le="3.0",method="GET",route="/user/{user_id}"}' in metrics
+    assert 'db_pool_connections{backend="async",state="idle"}' in metrics
+    assert 'achievement_cache_hits_total' in metrics
+
+    # Served without a pooled connection, so that a scrape still works while the pool is exhausted
+    monkeypatch.undo()
+    def connect(*args, **kwargs):
+        raise AssertionError('connected')
+    monkeypatch.setattr(database, 'connect', connect)
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'db_pool_connections_created_total{backend="sync"}' in response.text
+    assert client.get("/").status_code == 200
+
+def test_statistics_snapshot(monkeypatch):
+    user_id = create_user('testuser', Lang.EN)
+    other_id = create_user('testuser2', Lang.EN)
+    grant_user_achievement(user_id, create_achievement(10))
+    response = client.get("/statistics/max_score")
+    assert response.json()["id"] == user_id
+    assert response.headers["age"] == "0"
+    # Served without a pooled connection, so that snapshot hits still work while the pool is exhausted
+    with count_queries(monkeypatch) as queries, monkeypatch.context() as m:
+        m.setattr(database, 'connect', lambda *args, **kwargs: pytest.fail('connected'))
+        assert client.get("/statistics/max_score").json()["id"] == user_id
+    assert queries == []
+
+    # Without the refresher, a write of this process makes the next read recompute
+    grant_user_achievement(other_id, create_achievement(20))
+    assert client.get("/statistics/max_score").json()["id"] == other_id
+
+    # With it, reads are served from the snapshot, at most STATISTICS_MAX_AGE old, until it catches up
+    monkeypatch.setattr(main.statistics, 'refresh_interval', 60)
+    monkeypatch.setattr(main.statistics, 'max_age', 120)
+    with TestClient(app) as lifespan_client:
+        assert main.statistics.running
+        grant_user_achievement(user_id, create_achievement(30))
+        with count_queries(monkeypatch) as queries:
+            assert lifespan_client.get("/statistics/max_score").json()["id"] == other_id
+        assert queries == []
+        assert main.statistics.due()
+        asyncio.run(main.statistics.refresh())
+        assert not main.statistics.due()
+        assert lifespan_client.get("/statistics/max_score").json()["id"] == user_id
+        grant_user_achievement(other_id, create_achievement(30))
+        assert lifespan_client.get("/statistics/max_score", params={"fresh": True}).json()["id"] == other_id
+    assert not main.statistics.running
+
+def test_activity_rollup():
+    now = datetime.datetime.now()
+    user_id = create_user('testuser', Lang.EN)
+    other_id = create_user('testuser2', Lang.EN)
+    ten_id, five_id = create_achievement(10), create_achievement(5)
+    for achievement_id, days_ago in ((ten_id, 0), (five_id, 0), (ten_id, 2), (ten_id, 40)):
+        grant_user_achievement(user_id, achievement_id, now - datetime.timedelta(days=days_ago))
+    grant_user_achievements([(other_id, five_id, now), (other_id, ten_id, now - datetime.timedelta(days=1)),
+                             (other_id, ten_id, now - datetime.timedelta(days=1))])
+
+    def day(days_ago):
+        return (now - datetime.timedelta(days=days_ago)).date().isoformat()
+    response = client.get(f"/user/{user_id}/activity")
+    assert response.json() == [{"day": day(2), "grants": 1, "score": 10}, {"day": day(0), "grants": 2, "score": 15}]
+    assert len(client.get(f"/user/{user_id}/activity", params={"window": "41d"}).json()) == 3
+
+    def top(window):
+        return [(user["id"], user["score"], user["grants"]) for user in client.get("/statistics/top", params={"window": window}).json()]
+    assert top("1d") == [(user_id, 15, 2), (other_id, 5, 1)]
+    # Ties are ordered by id
+    assert top("7d") == [(user_id, 25, 3), (other_id, 25, 3)]
+    assert top("41d") == [(user_id, 35, 4), (other_id, 25, 3)]
+
+    with database.connection_context():
+        activity = list(app_db.UserActivity.select().order_by(app_db.UserActivity.user, app_db.UserActivity.day).tuples())
+        assert rebuild_activity() == 5
+        assert list(app_db.UserActivity.select().order_by(app_db.UserActivity.user, app_db.UserActivity.day).tuples()) == activity
+
+    for window in ("0d", "week", f"{main.MAX_WINDOW_DAYS + 1}d"):
+        assert client.get("/statistics/top", params={"window": window}).status_code == 422
+    assert client.get("/user/0/activity").status_code == 404
+
+def test_snapshot_bounds(monkeypatch):
+    version = 0
+    computed = []
+    now = 1000
+    monkeypatch.setattr('time.monotonic', lambda: now)
+    snapshot = Snapshot(lambda: version, max_age=10, refresh_interval=1, max_entries=2, max_idle=60)
+    def computation(key):
+        async def compute():
+            computed.append(key)
+            return key
+        return compute
+    async def request(*keys):
+        for key in keys:
+            await snapshot.get(key, computation(key))
+    # Only the two most recently requested keys are kept, and refreshing brings them up to date
+    asyncio.run(request(1, 2, 3, 4, 5))
+    version += 1
+    assert snapshot.due()
+    computed.clear()
+    asyncio.run(snapshot.refresh())
+    assert computed == [4, 5]
+    assert not snapshot.due()
+
+    # A key not requested for max_idle seconds is dropped rather than refreshed
+    now += 30
+    asyncio.run(request(4))
+    now += 40
+    version += 1
+    computed.clear()
+    asyncio.run(snapshot.refresh())
+    assert computed == [4]
+
+def test_export_import_round_trip():
+    now = datetime.datetime.now()
+    user_id = create_user('testuser', Lang.RU)
+    other_id = create_user('testuser2', Lang.EN)
+    first_id, second_id = create_achievement(5), create_achievement(7)
+    translate_achievement(first_id, Lang.RU, 'Заголовок', 'Описание')
+    translate_achievement(first_id, Lang.EN, 'Title', 'Description')
+    for days_ago in (1, 0):
+        grant_user_achievement(user_id, first_id, now - datetime.timedelta(days=days_ago))
+    grant_user_achievement(other_id, second_id, now)
+    response = client.get("/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    exported = response.text
+    assert [json.loads(line)["type"] for line in exported.splitlines()] == ['user', 'user', 'achievement', 'achievement', 'grant', 'grant', 'grant']
+    profile = client.get(f"/user/{user_id}").json()
+
+    drop_db()
+    create_db()
+    response = client.post("/import", content=exported.encode())
+    assert response.status_code == 200
+    assert response.json() == {'users': 2, 'achievements': 2, 'grants': 3}
+    assert client.get("/export").text == exported
+    assert client.get(f"/user/{user_id}").json() == profile
+    assert get_user(other_id).total_score == 7
+    assert client.get("/statistics/streak", params={"day_streak": 2}).json()[0]["id"] == user_id
+    assert create_user('testuser3', Lang.EN) == other_id + 1
+
+    assert client.post("/import", content=exported.encode()).status_code == 409
+    assert client.post("/import", content=b'{"type": "user", "id": 10}\n').status_code == 400
+    assert client.post("/import", content=b'not json\n').status_code == 400
+    assert create_user('testuser4', Lang.EN) == other_id + 2
+
+def test_paginated_listings(monkeypatch):
+    now = datetime.datetime.now()
+    user_id = create_user('testuser', Lang.RU)
+    achievement_ids = [create_achievement(score) for score in range(1, 6)]
+    for achievement_id in achievement_ids:
+        translate_achievement(achievement_id, Lang.RU, f'Заголовок {achievement_id}', 'Описание')
+    # Granted out of date order, two of them at the same moment
+    for achievement_id, days_ago in zip(achievement_ids, (2, 4, 3, 3, 0)):
+        grant_user_achievement(user_id, achievement_id, now - datetime.timedelta(days=days_ago))
+    by_date = [achievement_ids[i] for i in (1, 2, 3, 0, 4)]
+
+    def walk(url, **params):
+        ids, after = [], None
+        while True:
+            response = client.get(url, params={**params, **({"after": after} if after else {})})
+            assert response.status_code == 200
+            ids.append([item["id"] for item in response.json()])
+            after = response.headers.get("x-next-cursor")
+            if after is None:
+                return ids
+
+    achievement_cache.clear()
+    with count_queries(monkeypatch) as queries:
+        assert walk("/achievement", language="ru", limit=2) == [achievement_ids[0:2], achievement_ids[2:4], achievement_ids[4:]]
+    # Revision and one page query each, none left once the catalog is cached
+    assert len(queries) == 6
+    client.get("/achievement", params={"language": "ru"})
+    with count_queries(monkeypatch) as queries:
+        assert walk("/achievement", language="ru", limit=2) == [achievement_ids[0:2], achievement_ids[2:4], achievement_ids[4:]]
+    assert len(queries) == 3
+
+    assert walk(f"/achievements/{user_id}", limit=2) == [by_date[0:2], by_date[2:4], by_date[4:]]
+    assert walk(f"/achievements/{user_id}", limit=3, order="desc") == [by_date[::-1][0:3], by_date[::-1][3:]]
+    response = client.get(f"/achievements/{user_id}", params={"limit": 1})
+    assert response.json()[0]["translation"]["title"] == f'Заголовок {by_date[0]}'
+    assert datetime.datetime.fromisoformat(response.json()[0]["granted_at"]) == now - datetime.timedelta(days=4)
+
+    response = client.get(f"/achievements/{user_id}", params={"format": "ndjson", "limit": 2})
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == by_date
+    response = client.get("/achievement", params={"language": "all", "format": "ndjson"})
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == achievement_ids
+
+    assert client.get("/achievement", params={"language": "ru", "after": "garbage"}).status_code == 400
+    assert client.get(f"/achievements/{user_id}", params={"limit": 2, "after": "garbage"}).status_code == 400
+    assert client.get("/achievements/0", params={"limit": 2}).status_code == 404
+    assert client.get("/achievements/0", params={"format": "ndjson"}).status_code == 404
+    polyglot_id = create_user('polyglot', Lang.ALL)
+    grant_user_achievement(polyglot_id, achievement_ids[0])
+    for params in ({"limit": 2}, {"format": "ndjson"}):
+        response = client.get(f"/achievements/{polyglot_id}", params=params)
+        assert response.status_code == 200
+        granted, = [json.loads(line) for line in response.text.splitlines()] if "format" in params else response.json()
+        assert granted["id"] == achievement_ids[0] and granted["granted_at"]
+        assert [tl["language"] for tl in granted["translations"]] == ["ru"]
+    # Only a malformed cursor is a client error, not any ValueError raised by the store
+    def exhausted(*args, **kwargs):
+        raise MaxConnectionsExceeded('Exceeded maximum connections.')
+    monkeypatch.setattr(main.store, "get_achievements_page", exhausted)
+    monkeypatch.setattr(main.store, "get_user_achievements_page", exhausted)
+    failing_client = TestClient(app, raise_server_exceptions=False)
+    assert failing_client.get("/achievement", params={"language": "ru", "limit": 2}).status_code == 500
+    assert failing_client.get(f"/achievements/{user_id}", params={"limit": 2}).status_code == 500
+    monkeypatch.undo()
+
+    listings = ((f"/achievements/{user_id}", {"limit": 2, "order": "desc"}), ("/achievement", {"language": "ru", "limit": 3}))
+    pages = []
+    for url, params in listings:
+        response = client.get(url, params=params)
+        after = response.headers["x-next-cursor"]
+        pages.append((response.json(), after, client.get(url, params={**params, "after": after}).json()))
+    monkeypatch.setattr(main, 'store', db_async)
+    with TestClient(app) as async_client:
+        for (url, params), (first, after, second) in zip(listings, pages):
+            response = async_client.get(url, params=params)
+            assert response.json() == first
+            assert response.headers["x-next-cursor"] == after
+            assert async_client.get(url, params={**params, "after": after}).json() == second
+
+def test_translation_fallback_and_migration(monkeypatch):
+    drop_db()
+    # Schema of the first releases: one translation table per language
+    with database:
+        database.create_tables([Achievement, AchievementEn, AchievementRu])
+        both, english_only = Achievement.create(score=10).id, Achievement.create(score=20).id
+        AchievementEn.create(id=both, title='Title', description='Description')
+        AchievementRu.create(id=both, title='Заголовок', description='Описание')
+        AchievementEn.create(id=english_only, title='Only title', description='Only description')
+    create_db()
+    with database:
+        assert not AchievementEn.table_exists() and not AchievementRu.table_exists()
+
+    achievement_cache.clear()
+    with count_queries(monkeypatch) as queries:
+        response = client.get(f"/achievement/{both}", params={"id": both, "language": "all"})
+    assert [(tl["language"], tl["title"]) for tl in response.json()["translations"]] == [("en", "Title"), ("ru", "Заголовок")]
+    # Revision and one lookup of every translation
+    assert len(queries) == 2
+
+    response = client.get(f"/achievement/{english_only}", params={"id": english_only, "language": "ru"})
+    assert response.json()["translation"] == {"language": "en", "title": "Only title", "description": "Only description"}
+    user_id = create_user('testuser', Lang.RU)
+    grant_user_achievement(user_id, both)
+    grant_user_achievement(user_id, english_only)
+    assert [tl["translation"]["language"] for tl in client.get(f"/achievements/{user_id}").json()] == ["ru", "en"]
+
+    translate_achievement(english_only, Lang.RU, 'Перевод', 'Описание')
+    response = client.get(f"/achievement/{english_only}", params={"id": english_only, "language": "ru"})
+    assert response.json()["translation"]["title"] == 'Перевод'
+    with pytest.raises(ValueError):
+        translate_achievement(english_only, Lang.ALL, 'Title', 'Description')
+
+    expected = client.get("/achievement", params={"language": "all"}).json()
+    achievement_cache.clear()
+    monkeypatch.setattr(main, 'store', db_async)
+    with TestClient(app) as async_client:
+        assert async_client.get("/achievement", params={"language": "all"}).json() == expected
+
+def test_change_feed(monkeypatch):
+    user_id = create_user('testuser', Lang.EN)
+    other_id = create_user('testuser2', Lang.EN)
+    achievement_ids = [create_achievement(score) for score in (10, 20, 30)]
+    assert client.get("/events").status_code == 400
+
+    async def scenario():
+        feed = ChangeFeed(queue_size=3)
+        monkeypatch.setattr(main, 'changes', feed)
+        user = await feed.subscribe(user_id=user_id)
+        board = await feed.subscribe(leaderboard=True)
+        other = await feed.subscribe(user_id=other_id)
+        stream = main.change_stream(user, keepalive=0.05)
+        assert await anext(stream) == ': keepalive\n\n'
+
+        await asyncio.to_thread(grant_user_achievement, user_id, achievement_ids[0])
+        event = await asyncio.wait_for(anext(stream), 5)
+        assert event.startswith('event: grant\ndata: ')
+        assert json.loads(event.split('data: ')[1])["achievement_id"] == achievement_ids[0]
+        assert json.loads((await asyncio.wait_for(anext(stream), 5)).split('data: ')[1]) == \
+            {"type": "score", "user_id": user_id, "total_score": 10, "achievement_count": 1}
+        assert await asyncio.wait_for(board.get(), 5) == {"type": "score", "user_id": user_id, "total_score": 10, "achievement_count": 1}
+
+        await db_async.connect()
+        try:
+            await db_async.grant_user_achievement(user_id, achievement_ids[1])
+        finally:
+            await db_async.close()
+        assert [json.loads((await asyncio.wait_for(anext(stream), 5)).split('data: ')[1])["type"] for _ in range(2)] == ["grant", "score"]
+        assert (await asyncio.wait_for(board.get(), 5))["total_score"] == 30
+
+        # Three grant events and a score event do not fit a queue of three: the subscriber is dropped
+        await asyncio.to_thread(grant_user_achievements, [(other_id, achievement_id, None) for achievement_id in achievement_ids])
+        assert [(await asyncio.wait_for(other.get(), 5))["type"] for _ in range(3)] == ["grant"] * 3
+        assert await other.get() is None and other.closed == 'overflow'
+        assert other not in feed.subscriptions
+        assert (await asyncio.wait_for(board.get(), 5))["total_score"] == 60
+
+        await stream.aclose()
+        assert user not in feed.subscriptions
+        await feed.close()
+        assert await board.get() is None and board.closed == 'reset'
+
+    asyncio.run(scenario())
+
+def test_replica_routing(monkeypatch):
+    user_id = create_user('testuser', Lang.EN)
+    other_id = create_user('testuser2', Lang.EN)
+    achievement_id = create_achievement(10)
+    grant_user_achievement(other_id, achievement_id)
+    # The test database stands in for a replica, through a pool of its own; the second replica is unreachable
+    replicas = app_db.Replicas([database.database, 'postgresql://nobody@/nowhere?host=/nonexistent'], max_lag=5, max_connections=2)
+    replica, unreachable = replicas.databases
+    monkeypatch.setattr(app_db, 'replicas', replicas)
+    monkeypatch.setattr(db_functions, 'replicas', replicas)
+    monkeypatch.setattr(db_functions, 'recent_writes', app_db.RecentWrites(window=60))
+    monkeypatch.setattr(app_db, 'recent_writes', db_functions.recent_writes)
+    replicas.check()
+    assert replicas.healthy == [replica]
+
+    connections = []
+    execute_sql = database.execute_sql
+    def recording_execute_sql(sql, params=None, *args, **kwargs):
+        connections.append(database.connection())
+        return execute_sql(sql, params, *args, **kwargs)
+    monkeypatch.setattr(database, 'execute_sql', recording_execute_sql)
+    def served_by_replica(read, *args):
+        connections.clear()
+        result = read(*args)
+        replica_connections = {connection for *_, connection in replica._connections}
+        assert connections
+        return all(connection in replica_connections for connection in connections), result
+
+    try:
+        assert served_by_replica(db_functions.get_user_with_max_score) == (True, User.get_by_id(other_id))
+        assert served_by_replica(get_user, user_id)[0]
+        # Read-your-writes: the user just granted is read from the primary, the others still from the replica
+        grant_user_achievement(user_id, achievement_id)
+        assert served_by_replica(get_user, user_id) == (False, User.get_by_id(user_id))
+        assert served_by_replica(get_user, other_id)[0]
+        assert served_by_replica(db_functions.get_users_with_streak, 1)[0]
+        new_id = create_user('testuser3', Lang.EN)
+        assert served_by_replica(get_user, new_id) == (False, User.get_by_id(new_id))
+        # Reads of one request keep to the database the first one picked
+        choose = replicas.choose
+        chosen = []
+        monkeypatch.setattr(replicas, 'choose', lambda: chosen.append(choose()) or chosen[-1])
+        with db_functions.pinned_reads():
+            assert served_by_replica(get_user, other_id)[0]
+            assert served_by_replica(db_functions.get_users_with_streak, 1)[0]
+        assert chosen == [replica]
+        with db_functions.pinned_reads():
+            assert served_by_replica(get_user, user_id)[0] is False
+            assert served_by_replica(get_user, other_id)[0] is False
+        assert chosen == [replica]
+        response = client.get(f"/user/{other_id}")
+        assert response.status_code == 200 and response.json()["total_score"] == 10
+
+        # A replica failing mid-read is skipped and the read retried on the primary
+        replicas.healthy = [unreachable]
+        assert served_by_replica(db_functions.get_user_with_max_score)[1].total_score == 10
+        assert replicas.healthy == []
+        assert served_by_replica(get_user, other_id)[0] is False
+    finally:
+        replica.close_all()
+
+def test_schema_migrations():
+    assert migrations.apply_migrations() == []
+    migrations.check_schema()
+    with database.connection_context():
+        assert migrations.schema_version() == migrations.LATEST_VERSION
+        indexes = {index.name for index in database.get_indexes('userachievement')}
+        assert {'userachievement_user_id_date_id', 'userachievement_user_id_achievement_id'} <= indexes
+        # An interrupted concurrent build leaves an invalid index, which the next run rebuilds
+        database.execute_sql("UPDATE pg_index SET indisvalid = false WHERE indexrelid = 'user_total_score_id'::regclass")
+        app_db.SchemaVersion.delete().where(app_db.SchemaVersion.version >= 2).execute()
+    with pytest.raises(RuntimeError, match='migrate'):
+        migrations.check_schema()
+    with pytest.raises(RuntimeError):
+        with TestClient(app):
+            pass
+    assert migrations.apply_migrations() == list(range(2, migrations.LATEST_VERSION + 1))
+    with database.connection_context():
+        assert database.execute_sql("SELECT indisvalid FROM pg_index WHERE indexrelid = 'user_total_score_id'::regclass").fetchone() == (True,)
+
+    # Upgraded from a release without streaks and achievement counts: the backfill recomputes them from the grants
+    now = datetime.datetime.now()
+    user_id = create_user('testuser', Lang.EN)
+    achievement_id = create_achievement(10)
+    for days_ago in (2, 1, 0):
+        grant_user_achievement(user_id, achievement_id, now - datetime.timedelta(days=days_ago))
+    with database.connection_context():
+        User.update(achievement_count=0).execute()
+        app_db.UserStreak.delete().execute()
+        app_db.SchemaVersion.delete().where(app_db.SchemaVersion.version == 4).execute()
+    assert migrations.apply_migrations() == [4]
+    assert get_user(user_id).achievement_count == 3
+    assert [user["id"] for user in client.get("/statistics/streak", params={"day_streak": 3}).json()] == [user_id]
+
+def full_scans(query, share: float = 0.5) -> dict[str, float]:
+    """Tables of which the query reads more than `share` of the rows, by share read.
+
+    Sequential scans are priced out, so that plans on the small test tables are those of large ones; the rows each
+    scan actually reads (returned or filtered out) then tell an index range scan from a scan of the whole index.
+    """
+    sql, params = query if isinstance(query, tuple) else query.sql()
+    with database.atomic():
+        database.execute_sql('SET LOCAL enable_seqscan = off')
+        (plan,), = database.execute_sql('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql, params).fetchall()
+    nodes, read = [plan[0]['Plan']], {}
+    while nodes:
+        node = nodes.pop()
+        if 'Relation Name' in node and node['Relation Name'] != 'pg_class':
+            rows = (node['Actual Rows'] + node.get('Rows Removed by Filter', 0)) * node['Actual Loops']
+            read[node['Relation Name']] = read.get(node['Relation Name'], 0) + rows
+        nodes.extend(node.get('Plans', []))
+    sizes = {table: database.execute_sql(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in read}
+    return {table: round(rows / sizes[table], 2) for table, rows in read.items() if rows > share * sizes[table]}
+
+def test_hot_queries_use_indexes():
+    seed(300, 100, 3000, days=30, seed=2)
+    with database.connection_context():
+        database.execute_sql('ANALYZE')
+        user = User.select().order_by(User.id).first()
+        top = db_functions.leaderboard_query(1).first()
+        grant_ids = [grant_id for grant_id, in UserAchievement.select(UserAchievement.id).limit(2).tuples()]
+        hot_queries = {
+            'leaderboard': db_functions.leaderboard_query(20),
+            'leaderboard page': db_functions.leaderboard_query(20, db_functions.encode_leaderboard_cursor(user)),
+            'leaderboard ranks': db_functions.rank_counts_query(top),
+            'user rank': db_functions.user_rank_query(top),
+            'max score': db_functions.max_score_query(),
+            'max achievements': db_functions.max_achievements_query(),
+            'max score diff': db_functions.max_score_diff_query(),
+            'streaks': db_functions.streak_query(3),
+            'recount streaks': app_db.recount_streaks_sql([user.id]),
+            'top scorers': db_functions.top_scorers_query(1),
+            'user activity': db_functions.user_activity_query(user.id, 30),
+            'profile grants': db_functions.grants_query([user.id]),
+            'grants page': db_functions.user_grants_query(user.id, 10),
+            'grants next page': db_functions.user_grants_query(user.id, 10, db_functions.encode_grant_cursor(grant_ids[0], datetime.datetime.now())),
+            'duplicate grants': db_functions.grant_lookup_queries([(user.id, 1, None), (user.id, 2, None)], True)[2],
+            'catalog page': db_functions.achievements_page_query(0, 10),
+            'achievements': db_functions.missing_achievements_query([1, 2]),
+            'revisions': db_functions.revisions_query([app_db.CATALOG_REVISION, app_db.user_revision(user.id)]),
+        }
+        assert {name: tables for name, query in hot_queries.items() if (tables := full_scans(query))} == {}
+        # Adjacent score differences are a window over every user, read by the statistics snapshot rather than per request
+        assert full_scans(db_functions.min_score_diff_query(3)) == {'user': 1.0}